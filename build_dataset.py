@@ -4,9 +4,20 @@
 #
 #
 import os
+import time
+import random
 import argparse
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
 
 from utils import runcmd
+from model.clip_store import PackedClipWriter
+from model.manifest import ClipManifest, get_manifest_path
+from model.video_reader import VideoReader, sample_frame_indices, sample_clip_indices
 
 
 def get_dataset_arg():
@@ -22,6 +33,20 @@ def get_dataset_arg():
     parser.add_argument('--process_type', type=str, default='5_frames_uniform',
                         choices=['5_frames_uniform', '16_frames_conse_rand', '5_clips_16_frames'])
 
+    # Keep the downloaded zip as <data_folder>/<DATASET>/<process_type>.zip instead of unzipping it
+    # (train with --data_dir pointing to the .zip file)
+    parser.add_argument('--keep_zip', action='store_true')
+
+    # Extract the frames locally from the raw videos (<video_dir>/<class>/<video>.avi) instead of downloading
+    parser.add_argument('--video_dir', type=str, default='')
+    parser.add_argument('--num_processes', type=int, default=0)   # default: all available cores
+
+    # Precompute the clip manifest (frame files, labels, splits) of an extracted frame folder
+    parser.add_argument('--manifest', action='store_true')
+
+    # Pack an extracted frame folder into one memory-mapped file (use with --data_format packed)
+    parser.add_argument('--pack', action='store_true')
+
     return parser.parse_args()
 
 
@@ -45,9 +70,196 @@ def get_data_kaggle_id(dataset, process_type):
     return DATASET_IDS[dataset + '_' + process_type]
 
 
+def get_frame_indices(frame_count, process_type):
+    """
+    List of clips (list of frame indices) to extract from one video
+    """
+    if process_type == '5_clips_16_frames':
+        return sample_clip_indices(frame_count, clip_per_video=5)
+
+    return [sample_frame_indices(frame_count, process_type)]
+
+
+def extract_video(task):
+    """
+    Extract the frames of one video to <dst_path>/ (or <dst_path>/clip_k/ for 5_clips_16_frames).
+    Frames go to a temporary folder renamed at the end, so an existing dst_path is always complete.
+
+    Returns (number of frames written, error message or None)
+    """
+    video_path, dst_path, video_folder_path, process_type = task
+
+    if os.path.isdir(dst_path):
+        return 0, None
+
+    tmp_path = dst_path + '.tmp'
+
+    try:
+        # The same random clip every time the dataset is rebuilt
+        random.seed(video_folder_path)
+
+        reader = VideoReader(video_path)
+        clips = get_frame_indices(reader.frame_count, process_type)
+        frames = reader.read([index for indices in clips for index in indices])
+        reader.release()
+
+        n_frames = 0
+        for i, indices in enumerate(clips):
+
+            clip_path = os.path.join(tmp_path, f'clip_{i+1}') if len(clips) > 1 else tmp_path
+            os.makedirs(clip_path, exist_ok=True)
+
+            for j in range(len(indices)):
+                cv2.imwrite(os.path.join(clip_path, f'frame_{j:02d}.jpg'),
+                            cv2.cvtColor(frames[n_frames], cv2.COLOR_RGB2BGR))
+                n_frames += 1
+
+        os.rename(tmp_path, dst_path)
+
+    except Exception as e:
+        return 0, f'{video_path}: {e}'
+
+    return n_frames, None
+
+
+def init_extract_worker():
+    # One process per core already, no extra OpenCV threads
+    cv2.setNumThreads(1)
+
+
+def extract_dataset(video_dir, data_folder, dataset, process_type, num_processes):
+    """
+    Extract <data_folder>/<DATASET>/<process_type>/ from the raw videos with a process pool.
+    Videos already extracted are skipped, so an interrupted run can be resumed.
+    """
+    final_data_folder = os.path.join(data_folder, dataset.upper(), process_type)
+
+    df = pd.read_csv(os.path.join(data_folder, dataset.upper(), 'annotation', 'train_test_split.csv'))
+
+    tasks = []
+    for video_folder_path in df['video_folder_path']:
+        dst_path = os.path.join(final_data_folder, video_folder_path)
+
+        if os.path.isdir(dst_path):
+            continue
+
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        tasks.append((os.path.join(video_dir, video_folder_path + '.avi'), dst_path, video_folder_path, process_type))
+
+    if not num_processes:
+        num_processes = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+    print(f"Extracting {process_type} frames of {len(tasks)} videos to {final_data_folder} "
+          f"({len(df) - len(tasks)} already done) with {num_processes} processes...")
+
+    n_frames = 0
+    errors = []
+    start = time.time()
+
+    with Pool(num_processes, initializer=init_extract_worker) as pool:
+        with tqdm(total=len(tasks)) as t:
+            for n_video_frames, error in pool.imap_unordered(extract_video, tasks, chunksize=4):
+
+                n_frames += n_video_frames
+                if error is not None:
+                    errors.append(error)
+
+                elapsed = time.time() - start
+                t.set_postfix(videos_per_s='{:.1f}'.format((t.n + 1) / elapsed),
+                              frames_per_s='{:.0f}'.format(n_frames / elapsed))
+                t.update()
+
+    elapsed = time.time() - start
+    print(f"Extracted {n_frames} frames of {len(tasks) - len(errors)} videos in {elapsed:.0f}s "
+          f"({n_frames / max(elapsed, 1e-6):.0f} frames/s)")
+
+    if errors:
+        print(f"Failed on {len(errors)} videos (run again to retry):")
+        for error in errors:
+            print(" ", error)
+
+
+def build_manifest(data_folder, dataset, process_type):
+    """
+    Save the manifest of <data_folder>/<DATASET>/<process_type>/ next to the annotation CSVs
+    """
+    frame_folder = os.path.join(data_folder, dataset.upper(), process_type)
+    annotation_csv = os.path.join(data_folder, dataset.upper(), 'annotation', 'train_test_split.csv')
+
+    print(f"Building the clip manifest of {frame_folder}...")
+
+    manifest = ClipManifest.build(annotation_csv, frame_folder)
+
+    manifest_path = get_manifest_path(dataset, frame_folder)
+    manifest.save(manifest_path)
+
+    print(f"Save {len(manifest)} videos, {len(manifest.clip_paths)} clips and {len(manifest.frame_names)} frames "
+          f"to {manifest_path}")
+
+
+def read_frame_folder(folder_path):
+    frames = [cv2.imread(os.path.join(folder_path, name)) for name in sorted(os.listdir(folder_path))]
+    return np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames], axis=0)
+
+
+def pack_dataset(data_folder, dataset, process_type):
+    """
+    Pack <data_folder>/<DATASET>/<process_type>/ into <process_type>_packed/:
+    frames.bin (all RGB frames as one flat uint8 array) and index.npz (clip -> offset, shape)
+    """
+    frame_folder = os.path.join(data_folder, dataset.upper(), process_type)
+    packed_folder = frame_folder + '_packed'
+
+    df = pd.read_csv(os.path.join(data_folder, dataset.upper(), 'annotation', 'train_test_split.csv'))
+
+    print(f"Packing {frame_folder} to {packed_folder}...")
+
+    n_missing = 0
+
+    with PackedClipWriter(packed_folder) as writer:
+        for video_folder_path in tqdm(df['video_folder_path']):
+
+            video_path = os.path.join(frame_folder, video_folder_path)
+
+            if not os.path.isdir(video_path):
+                n_missing += 1
+                continue
+
+            # 5_clips_16_frames: one sub folder per clip (clip_1, clip_2, ..)
+            sub_folders = sorted(name for name in os.listdir(video_path)
+                                 if os.path.isdir(os.path.join(video_path, name)))
+
+            if sub_folders:
+                for name in sub_folders:
+                    writer.add(os.path.join(video_folder_path, name),
+                               read_frame_folder(os.path.join(video_path, name)))
+            else:
+                writer.add(video_folder_path, read_frame_folder(video_path))
+
+        n_clips = len(writer.keys)
+        n_bytes = writer.n_items
+
+    if n_missing:
+        print(f"Warning: {n_missing} videos of the annotation are missing in {frame_folder}")
+
+    print(f"Packed {n_clips} clips ({n_bytes / 1024 ** 3:.2f} GB)")
+
+
 if __name__ == '__main__':
     args = get_dataset_arg()
 
+    if args.manifest:
+        build_manifest(args.data_folder, args.dataset, args.process_type)
+        exit()
+
+    if args.pack:
+        pack_dataset(args.data_folder, args.dataset, args.process_type)
+        exit()
+
+    if args.video_dir:
+        extract_dataset(args.video_dir, args.data_folder, args.dataset, args.process_type, args.num_processes)
+        exit()
+
     if args.process_type == '5_clips_16_frames':
         raise("Big file !Please using Google Colab version and download in google colab instead.")
 
@@ -62,7 +274,7 @@ if __name__ == '__main__':
                                      args.dataset.upper(),
                                      args.process_type)
 
-    if not os.path.exists(final_data_folder):
+    if not args.keep_zip and not os.path.exists(final_data_folder):
         os.makedirs(final_data_folder)
 
     print("-" * 20)
@@ -87,11 +299,20 @@ if __name__ == '__main__':
         download_id = get_data_kaggle_id(args.dataset, args.process_type)
         runcmd(f'kaggle datasets download -d {download_id} -p "./temp/"', is_wait=True)
 
-    print("Unzip the dataset...")
-
     if not os.path.exists(os.path.join('./temp', zip_file_name)):
         zip_file_name = os.listdir('./temp')[0]
 
+    if args.keep_zip:
+        print(f"Keep the dataset archive at {final_data_folder}.zip ...")
+
+        runcmd(f'mv ./temp/{zip_file_name} {final_data_folder}.zip && rm -rf ./temp/', is_wait=True)
+
+        print("--DONE--")
+        print("-" * 20)
+        exit()
+
+    print("Unzip the dataset...")
+
     runcmd(f'unzip -qo ./temp/{zip_file_name} -d {final_data_folder} \
             && rm -rf ./temp/                                        \
             && mv {final_data_folder}/kaggle/temp/*/* {final_data_folder}/ \
@@ -6,20 +6,12 @@ import argparse
 
 from tqdm import tqdm
 
-from sklearn.metrics import confusion_matrix
 import torch
 from torch import nn
-from model.lrcn import LRCN
-from model.c3d import C3D
-from model.i3d import I3D
-from model.non_local_i3res import NonLocalI3Res
-from model.late_fusion import LateFusion
+from model import MODEL_NAMES, add_model_args, build_model
 from model.data_loader import ActionRecognitionDataWrapper
 from utils import WandbLogger, get_map_id_to_label
 import utils
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import warnings
 warnings.simplefilter("ignore", UserWarning)
 
@@ -42,40 +34,32 @@ def get_arg_parser():
                         choices=['split1', 'split2', 'split3'])
     parser.add_argument('--batch_size', type=int, default=32)
     parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--autotune', action='store_true')   # probe the loader settings (saved in ./data/loader_autotune.json)
+    parser.add_argument('--ring_collate', action='store_true')   # collate into reused (pinned) batch buffers
+    parser.add_argument('--decode_threads', type=int, default=0)   # threads decoding the frames of a clip in each worker
+    parser.add_argument('--prefetch_batches', type=int, default=2)   # batches staged on the device ahead, 0: no thread
     parser.add_argument('--clip_per_video', type=int, default=1)
+    parser.add_argument('--normalize_on_device', action='store_true')   # workers ship uint8 clips
+    parser.add_argument('--full_decode', action='store_true')   # no reduced scale JPEG decode
+    parser.add_argument('--cache_dir', type=str, default='')   # on-disk cache of the resized frames
+    parser.add_argument('--cache_gb', type=float, default=0)   # shared memory cache of the decoded clips
+    parser.add_argument('--data_format', type=str, default='frames',
+                        choices=['frames', 'packed', 'features', 'video'])   # features: see extract_features.py
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=utils.PRECISIONS)   # autocast of the forward passes, bf16 also on CPU
 
     # Module specific args
     # which model to use
     parser.add_argument('--model_name', type=str, required=True,
-                        choices=["lrcn", "c3d", "i3d", "non_local", "late_fusion"])
+                        choices=MODEL_NAMES)
 
     # Get the model name now
     temp_args, _ = parser.parse_known_args()
 
-    if temp_args.model_name == "lrcn":
-        parser = LRCN.add_model_specific_args(parser)
+    if temp_args.data_format == 'features' and temp_args.model_name not in ['late_fusion', 'lrcn']:
+        parser.error("--data_format features only supports the ResNet152 based models (late_fusion, lrcn)")
 
-        # Data transform
-        parser.add_argument('--resize_to', type=int, default=256)   # 5 uni
-
-    elif temp_args.model_name == "c3d":
-        parser = C3D.add_model_specific_args(parser)
-
-        # Data transform
-        parser.add_argument('--resize_to', type=int, default=112)   # 16 frames clip
-
-    elif temp_args.model_name == "i3d":
-        parser = I3D.add_model_specific_args(parser)
-        # Data transform
-        parser.add_argument('--resize_to', type=int, default=224)   # Maybe 224
-
-    elif temp_args.model_name == "non_local":
-        parser = NonLocalI3Res.add_model_specific_args(parser)
-        parser.add_argument('--resize_to', type=int, default=224)
-
-    elif temp_args.model_name == "late_fusion":
-        parser = LateFusion.add_model_specific_args(parser)
-        parser.add_argument('--resize_to', type=int, default=256)   # 5 uni
+    parser = add_model_args(parser, temp_args.model_name)
 
     # Wandb specific args
     parser.add_argument('--enable_wandb', action='store_true')
@@ -93,30 +77,37 @@ def val_evaluate(model, data_loader, criterion, metrics, args):
     acc_summ = 0
     loss_summ = 0
 
+    # Batches moved to the device and normalized on a background thread
+    batches = utils.BatchPrefetcher(data_loader, args.device, depth=args.prefetch_batches)
+
+    autocast = utils.get_autocast(args.precision, args.device)
+    meter = utils.ThroughputMeter(args.device)
+
     with torch.no_grad():
         with tqdm(total=len(data_loader)) as t:
-            for data in data_loader:
+            for data in batches:
 
                 image, label = data
 
-                image = image.to(args.device, non_blocking=True)
-                label = label.to(args.device, non_blocking=True)
-
                 # forward
-                output = model(image)
+                with autocast:
+                    output = model(image)
+                output = output.float()   # loss and metrics in fp32
                 loss = criterion(output, label)
 
                 acc = metrics(output, label)
 
                 acc_summ += acc.item()
                 loss_summ += loss.item()
+                meter.update(len(image))
 
                 t.update()
 
     acc_mean = acc_summ / len(data_loader)
     loss_mean = loss_summ / len(data_loader)
 
-    print(f'Val loss: {loss_mean:05.3f} ... Val acc: {acc_mean:05.3f}')
+    print(f'Val loss: {loss_mean:05.3f} ... Val acc: {acc_mean:05.3f} ... Data wait: {batches.data_wait():.0%} ... '
+          f'Throughput ({args.precision}): {meter.clips_per_second():.1f} clips/s ... Peak memory: {meter.peak_memory_gb():.2f}GB')
 
     return loss_mean, acc_mean
 
@@ -134,17 +125,22 @@ def test_evaluate(model, test_data_loader, metrics, cfmatrix_save_folder, args):
         y_preds = []
         y_true = []
 
+    autocast = utils.get_autocast(args.precision, args.device)
+    meter = utils.ThroughputMeter(args.device)
+
     with torch.no_grad():
         with tqdm(total=len(test_data_loader)) as t:
             for data in test_data_loader:
                 clip, label = data
                 if args.clip_per_video <= 1:
 
-                    clip = clip.to(args.device, non_blocking=True)
+                    clip = utils.normalize_batch(clip.to(args.device, non_blocking=True))
                     label = label.to(args.device, non_blocking=True)
 
-                    # forward
-                    output = torch.softmax(model(clip), dim=1)
+                    # forward, softmax in fp32
+                    with autocast:
+                        logits = model(clip)
+                    output = torch.softmax(logits.float(), dim=1)
 
                 else:
                     outputs = []
@@ -152,15 +148,18 @@ def test_evaluate(model, test_data_loader, metrics, cfmatrix_save_folder, args):
                     label = label.to(args.device, non_blocking=True)
                     for i in range(args.clip_per_video):
 
-                        clip = clips[:, i, :, :, :].to(args.device, non_blocking=True)
-                        # forward
-                        outputs.append(torch.softmax(model(clip), dim=1))
+                        clip = utils.normalize_batch(clips[:, i, :, :, :].to(args.device, non_blocking=True))
+                        # forward, softmax in fp32
+                        with autocast:
+                            logits = model(clip)
+                        outputs.append(torch.softmax(logits.float(), dim=1))
 
                     outputs = torch.stack(outputs, dim=1)
                     output = torch.mean(outputs, dim=1)
 
                 acc = metrics(output, label)
                 acc_summ += acc.item()
+                meter.update(len(label) * max(args.clip_per_video, 1))
 
                 if cfmatrix_save_folder is not None:
                     y_preds.extend(output.argmax(1).data.cpu().numpy())
@@ -170,9 +169,16 @@ def test_evaluate(model, test_data_loader, metrics, cfmatrix_save_folder, args):
 
     acc_mean = acc_summ / len(test_data_loader)
 
-    print(f'Test acc: {acc_mean:05.3f}')
+    print(f'Test acc: {acc_mean:05.3f} ... Throughput ({args.precision}): {meter.clips_per_second():.1f} clips/s ... '
+          f'Peak memory: {meter.peak_memory_gb():.2f}GB')
 
     if cfmatrix_save_folder is not None:
+        # Plotting libraries are only needed here
+        from sklearn.metrics import confusion_matrix
+        import pandas as pd
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
         size_confusion = {'ucf101': (34, 24), 'hmdb51': (24, 17)}
         cf_matrix = confusion_matrix(y_true, y_preds)
         plt.figure(figsize=size_confusion[args.dataset])
@@ -209,30 +215,8 @@ if __name__ == '__main__':
     # Get test loader
     test_loader = data_wrapper.get_test_dataloader()
 
-    # Get NUM_CLASSES
-    if args.dataset == 'hmdb51':
-        args.NUM_CLASSES = 51
-    else:
-        args.NUM_CLASSES = 101
-
     # Get model
-    if args.model_name == "lrcn":
-        net = LRCN(**dict_args,
-                   n_class=args.NUM_CLASSES)
-    elif args.model_name == "c3d":
-        net = C3D(**dict_args,
-                  n_class=args.NUM_CLASSES)
-    elif args.model_name == "i3d":
-        net = I3D(**dict_args,
-                  num_classes=args.NUM_CLASSES)
-
-    elif args.model_name == "non_local":
-        net = NonLocalI3Res(**dict_args,
-                            num_classes=args.NUM_CLASSES)
-
-    elif args.model_name == "late_fusion":
-        net = LateFusion(**dict_args,
-                         n_class=args.NUM_CLASSES)
+    net = build_model(**dict_args)
 
     net.to(args.device)
 
@@ -240,7 +224,7 @@ if __name__ == '__main__':
     criterion = nn.CrossEntropyLoss()
 
     # Load weights
-    utils.load_checkpoint(os.path.join(args.ckp_dir, args.restore_file), net)
+    utils.load_checkpoint(os.path.join(args.ckp_dir, args.restore_file), net, map_location=args.device)
 
     # Evaluate
     test_acc = test_evaluate(net, test_loader, utils.acc_metrics, args.ckp_dir, args)
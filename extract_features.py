@@ -0,0 +1,126 @@
+#
+# Extract the frozen ResNet152 features once for Late Fusion and LRCN
+# Then train / evaluate the heads with --data_format features --data_dir <out_dir>
+#
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+from model.data_loader import DATASET_CLASSES
+from model.clip_store import PackedClipWriter
+from model.utils.late_fusion_model import PretrainedConv
+import utils
+import warnings
+warnings.simplefilter("ignore", UserWarning)
+
+
+FLUSH_BATCHES = 50   # the store index is saved every n batches, where --resume continues from
+
+
+def get_arg_parser():
+    """
+    Get options from CLI
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data_dir', type=str, required=True)
+    parser.add_argument('--data_format', type=str, default='frames',
+                        choices=['frames', 'packed'])
+    parser.add_argument('--out_dir', type=str, default='')   # default: <data_dir>_features
+    parser.add_argument('--dataset', type=str, required=True,
+                        choices=['hmdb51', 'ucf101'])
+    parser.add_argument('--clip_per_video', type=int, default=1)
+    parser.add_argument('--resize_to', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--resume', action='store_true')   # skip the clips already in <out_dir>
+
+    return parser.parse_args()
+
+
+def get_all_clips(dataset, clip_per_video):
+    """
+    Every clip of the dataset (all splits), one row per clip folder
+    """
+    df = pd.read_csv(f'./data/{dataset.upper()}/annotation/train_test_split.csv')
+
+    if clip_per_video > 1:
+        df['video_folder_path'] = df['video_folder_path'].apply(
+            lambda name_clip: [os.path.join(name_clip, f'clip_{x+1}') for x in range(clip_per_video)])
+        df = df.explode('video_folder_path').reset_index(drop=True)
+
+    return df['video_folder_path'].to_numpy(dtype=str), df['label_id'].to_numpy()
+
+
+def get_trunk():
+    """
+    The frozen ResNet152 of PretrainedConv / Pretrained_conv without its fc: 2048-d pooled features.
+    Batch norm uses the ImageNet statistics, as the trunk of the models does in training too
+    """
+    trunk = PretrainedConv(latent_dim=1).conv_model
+    trunk.fc = nn.Identity()
+    return trunk
+
+
+def extract_features(trunk, data_loader, writer, clip_keys, args):
+
+    trunk.eval()
+
+    n_done = 0
+
+    with torch.no_grad():
+        for step, (image, _) in enumerate(tqdm(data_loader)):
+
+            batch_size, timesteps, channel_x, h_x, w_x = image.shape
+            image = image.to(args.device, non_blocking=True)
+
+            features = trunk(image.view(batch_size * timesteps, channel_x, h_x, w_x))
+            features = features.view(batch_size, timesteps, -1).cpu().numpy()
+
+            for clip_features in features:
+                writer.add(clip_keys[n_done], clip_features)
+                n_done += 1
+
+            if (step + 1) % FLUSH_BATCHES == 0:
+                writer.flush()
+
+
+if __name__ == '__main__':
+
+    args = get_arg_parser()
+    args.device = utils.get_training_device()
+
+    out_dir = args.out_dir or args.data_dir.rstrip('/') + '_features'
+
+    clip_paths, labels = get_all_clips(args.dataset, args.clip_per_video)
+
+    with PackedClipWriter(out_dir, dtype='float32', resume=args.resume) as writer:
+
+        # Resume: only the clips after the last saved index
+        if writer.keys:
+            todo = ~np.isin(clip_paths, writer.keys)
+            print(f"Resume: {len(clip_paths) - todo.sum()} clips already extracted")
+            clip_paths, labels = clip_paths[todo], labels[todo]
+
+        dataset_class, _ = DATASET_CLASSES[args.data_format]
+        clip_dataset = dataset_class(args.data_dir,
+                                     clip_paths,
+                                     labels,
+                                     utils.get_transforms(args)['test_transforms'])
+
+        data_loader = DataLoader(clip_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+
+        trunk = get_trunk().to(args.device)
+
+        print(f"Extracting ResNet152 features of {len(clip_paths)} clips to {out_dir}...")
+
+        extract_features(trunk, data_loader, writer, clip_paths, args)
+
+    print("--DONE--")
@@ -1,13 +1,9 @@
-from model.lrcn import LRCN
-from model.c3d import C3D
-from model.i3d import I3D
-from model.non_local_i3res import NonLocalI3Res
-from model.late_fusion import LateFusion
+from model import MODEL_NAMES, add_model_args, build_model
+from model.video_reader import SAMPLE_TYPES, VideoReader, sample_frame_indices
 import argparse
-import random
+import numpy as np
 import utils
 import torch
-import cv2
 import warnings
 warnings.simplefilter("ignore", UserWarning)
 
@@ -25,39 +21,12 @@ def get_arg_parser():
 
     # Module specific args
     parser.add_argument('--model_name', type=str, required=True,
-                        choices=["lrcn", "c3d", "i3d", "non_local", "late_fusion"])
+                        choices=MODEL_NAMES)
 
     # Get the model name now
     temp_args, _ = parser.parse_known_args()
 
-    if temp_args.model_name == "lrcn":
-        parser = LRCN.add_model_specific_args(parser)
-
-        parser.add_argument('--sample_type', type=str, default='5_frames_uniform')
-        parser.add_argument('--resize_to', type=int, default=256)
-
-    elif temp_args.model_name == "c3d":
-        parser = C3D.add_model_specific_args(parser)
-        # Data transform
-        parser.add_argument('--sample_type', type=str, default='16_frames_conse_rand')
-        parser.add_argument('--resize_to', type=int, default=112)
-
-    elif temp_args.model_name == "i3d":
-        parser = I3D.add_model_specific_args(parser)
-        # Data transform
-        parser.add_argument('--sample_type', type=str, default='16_frames_conse_rand')
-        parser.add_argument('--resize_to', type=int, default=224)
-
-    elif temp_args.model_name == "non_local":
-        parser = NonLocalI3Res.add_model_specific_args(parser)
-
-        parser.add_argument('--sample_type', type=str, default='16_frames_conse_rand')
-        parser.add_argument('--resize_to', type=int, default=224)
-
-    elif temp_args.model_name == "late_fusion":
-        parser = LateFusion.add_model_specific_args(parser)
-        parser.add_argument('--sample_type', type=str, default='5_frames_uniform')
-        parser.add_argument('--resize_to', type=int, default=256)   # 5 uni
+    parser = add_model_args(parser, temp_args.model_name)
 
     return parser.parse_args()
 
@@ -66,78 +35,28 @@ def extract_features_from_video(video_path, type, transform, *args, **kwargs):
     """
     return a stack of torch based on type
     """
-    frames = []
-    # Read the Video
-    video_reader = cv2.VideoCapture(video_path)
-
-    frame_count = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
-
-    if type == "5_frames_uniform":
-        if frame_count < 5:
-            raise NotImplementedError
-
-        # Calculate the interval after which frames will be added to the list
-        skip_interval = max(int(frame_count / 5), 1)
-
-        for counter in range(5):
-            # Set the current frame postion of the video
-            video_reader.set(cv2.CAP_PROP_POS_FRAMES, counter * skip_interval)
-            # Read the current frame
-            ret, frame = video_reader.read()
-            if not ret:
-                break
-            img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frames.append(transform(image=img)['image'])
-
-    elif type == "16_frames_conse_rand":
-        if frame_count < 16:
-            raise NotImplementedError
-
-        start_point = random.randint(0, frame_count - 16 - 1)
-
-        for counter in range(16):
-            # Set the current frame postion of the video
-            video_reader.set(cv2.CAP_PROP_POS_FRAMES, start_point + counter)
-            # Read the current frame
-            ret, frame = video_reader.read()
-            if not ret:
-                break
-
-            img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frames.append(transform(image=img)['image'])
-    else:
-        raise("Not supporting this sample type.")
+    if type not in SAMPLE_TYPES:
+        raise ValueError("Not supporting this sample type.")
 
-    video_reader.release()
-    return torch.stack(frames, dim=0)
+    # Read the Video (sequential decoding, no seek per frame)
+    video_reader = VideoReader(video_path)
 
+    frame_indices = sample_frame_indices(video_reader.frame_count, type)
 
-def load_model(dataset, model_name, **kwargs):
-    # Get NUM_CLASSES
-    if dataset == 'hmdb51':
-        NUM_CLASSES = 51
-    else:
-        NUM_CLASSES = 101
+    # No clamped / repeated frames here (unlike the video datasets): the video must be as long as the clip
+    if video_reader.frame_count < len(frame_indices):
+        video_reader.release()
+        raise NotImplementedError(f"{video_path} has {video_reader.frame_count} frames, {type} needs {len(frame_indices)}")
 
-    if model_name == "lrcn":
-        net = LRCN(**kwargs,
-                   n_class=NUM_CLASSES)
-    elif model_name == "c3d":
-        net = C3D(**kwargs,
-                  n_class=NUM_CLASSES)
-    elif model_name == "i3d":
-        net = I3D(**kwargs,
-                  num_classes=NUM_CLASSES)
+    frames = video_reader.read(frame_indices)
 
-    elif model_name == "non_local":
-        net = NonLocalI3Res(**kwargs,
-                            num_classes=NUM_CLASSES)
+    video_reader.release()
+    return transform(np.stack(frames, axis=0))
 
-    elif model_name == "late_fusion":
-        net = LateFusion(**kwargs,
-                         n_class=NUM_CLASSES)
 
-    return net
+def load_model(dataset, model_name, **kwargs):
+    # Only the module of model_name is imported
+    return build_model(model_name, dataset, **kwargs)
 
 
 def predict_model(model, features, args):
@@ -169,7 +88,7 @@ def predict(video_path, weight_path, dataset, model_name, sample_type, resize_to
 
     net.to(device)
 
-    utils.load_checkpoint(weight_path, net)
+    utils.load_checkpoint(weight_path, net, map_location=device)
 
     transform = utils.get_transforms(args)['test_transforms']
 
@@ -0,0 +1,57 @@
+#
+# Model registry: a model module (and torchvision, pretrained weights helpers...) is only imported
+# once that model is selected, so train.py / evaluate.py / inference.py start without loading all five
+#
+import importlib
+
+
+# model_name: (module, class, number of classes argument, default --resize_to, default --sample_type)
+MODELS = {
+    'lrcn': ('model.lrcn', 'LRCN', 'n_class', 256, '5_frames_uniform'),
+    'c3d': ('model.c3d', 'C3D', 'n_class', 112, '16_frames_conse_rand'),
+    'i3d': ('model.i3d', 'I3D', 'num_classes', 224, '16_frames_conse_rand'),
+    'non_local': ('model.non_local_i3res', 'NonLocalI3Res', 'num_classes', 224, '16_frames_conse_rand'),
+    'late_fusion': ('model.late_fusion', 'LateFusion', 'n_class', 256, '5_frames_uniform'),
+}
+
+MODEL_NAMES = list(MODELS)
+
+NUM_CLASSES = {'hmdb51': 51, 'ucf101': 101}
+
+
+def get_model_class(model_name):
+    """
+    Import the module of model_name and return its class
+    """
+    module_name, class_name, _, _, _ = MODELS[model_name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def add_model_args(parser, model_name):
+    """
+    Model specific args, then the data transform defaults of the model
+    """
+    _, _, _, resize_to, sample_type = MODELS[model_name]
+
+    parser = get_model_class(model_name).add_model_specific_args(parser)
+
+    # Data transform
+    parser.add_argument('--resize_to', type=int, default=resize_to)
+    parser.add_argument('--sample_type', type=str, default=sample_type)   # --data_format video
+
+    return parser
+
+
+def build_model(model_name, dataset, activation_checkpointing='none', **kwargs):
+    """
+    The model with the number of classes of dataset
+    activation_checkpointing: 'stage' or 'block' to recompute the activations of the 3D CNNs during the backward pass
+    """
+    _, _, n_class_arg, _, _ = MODELS[model_name]
+    model = get_model_class(model_name)(**kwargs, **{n_class_arg: NUM_CLASSES[dataset]})
+
+    if activation_checkpointing != 'none':
+        from .utils.utils import set_activation_checkpointing
+        set_activation_checkpointing(model, activation_checkpointing)
+
+    return model
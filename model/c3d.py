@@ -1,11 +1,7 @@
-import os 
-
-
-import torch
 from torch import nn
 
 from .utils import c3d_model
-from .utils.utils import download_weights
+from .weight_store import WeightStore
 
 
 
@@ -22,12 +18,7 @@ class C3D(c3d_model.C3D):
         super(C3D, self).__init__(drop_out=drop_out)
         
         if pretrain:
-            file_name = "c3d.pickle"
-            weight_path = os.path.join(weight_folder, file_name)
-            if not os.path.exists(weight_path):
-                print("Download C3D pretrained on Sports1M..")
-                download_weights(weight_folder, file_name)
-            self.load_state_dict(torch.load(weight_path))
+            self.load_state_dict(WeightStore(weight_folder).load('c3d'))
 
             print("Load C3D pretrained weights successfully.")
 
@@ -0,0 +1,437 @@
+#
+# Packed clip store: every clip of a dataset in one flat array on disk
+# plus an offset index, so reading a clip is one slice of a memory map.
+#
+
+import os
+import zlib
+import atexit
+import shutil
+import hashlib
+import struct
+import zipfile
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+DATA_FILE = 'frames.bin'
+INDEX_FILE = 'index.npz'
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png')
+
+
+def clip_sort_key(clip_key):
+    """
+    Sort key of the clips of a video: clip_2 before clip_10 (clip_<k> by k), other names as text
+    """
+    name = os.path.basename(clip_key)
+    number = name[len('clip_'):]
+
+    if name.startswith('clip_') and number.isdigit():
+        return 0, int(number), name
+    return 1, 0, name
+
+
+class PackedClipWriter():
+    """Append clips (numpy arrays) to a packed store
+
+    Example:
+    ```
+    with PackedClipWriter('./data/UCF101/5_frames_uniform_packed/') as writer:
+        writer.add('ApplyEyeMakeup/v_ApplyEyeMakeup_g01_c01', clip)   # (T, H, W, C) uint8
+    ```
+    resume=True continues an interrupted store from its last flush() (writer.keys: the clips already in it)
+    """
+    def __init__(self, store_dir, dtype=np.uint8, resume=False):
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self.store_dir = store_dir
+        self.dtype = np.dtype(dtype)
+
+        self.keys = []
+        self.offsets = []
+        self.shapes = []
+        self.n_items = 0     # number of elements written so far
+
+        data_path = os.path.join(store_dir, DATA_FILE)
+        index_path = os.path.join(store_dir, INDEX_FILE)
+
+        if resume and os.path.exists(data_path) and os.path.exists(index_path):
+            self._load_index(index_path)
+            # Drop what was written after the last flush
+            self._file = open(data_path, 'r+b')
+            self._file.truncate(self.n_items * self.dtype.itemsize)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(data_path, 'wb')
+
+    def _load_index(self, index_path):
+
+        with np.load(index_path) as index:
+            if np.dtype(str(index['dtype'])) != self.dtype:
+                raise ValueError(f"Can not resume {self.store_dir}: stored as {index['dtype']}, not {self.dtype.str}")
+
+            self.keys = index['keys'].tolist()
+            self.offsets = index['offsets'].tolist()
+            self.shapes = [tuple(shape) for shape in index['shapes'].tolist()]
+
+        if self.keys:
+            self.n_items = self.offsets[-1] + int(np.prod(self.shapes[-1]))
+
+    def add(self, clip_key, clip):
+
+        clip = np.ascontiguousarray(clip, dtype=self.dtype)
+
+        if self.shapes and len(self.shapes[0]) != clip.ndim:
+            raise ValueError(f"All clips need {len(self.shapes[0])} dims, got {clip.shape} for {clip_key}")
+
+        self._file.write(clip.tobytes())
+
+        self.keys.append(clip_key)
+        self.offsets.append(self.n_items)
+        self.shapes.append(clip.shape)
+        self.n_items += clip.size
+
+    def _write_index(self):
+
+        tmp_path = os.path.join(self.store_dir, f'{os.getpid()}.tmp.npz')
+        np.savez(tmp_path,
+                 keys=np.array(self.keys, dtype=str),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 shapes=np.array(self.shapes, dtype=np.int64),
+                 dtype=np.array(self.dtype.str))
+        os.replace(tmp_path, os.path.join(self.store_dir, INDEX_FILE))
+
+    def flush(self):
+        """
+        Make the clips added so far readable, and the point a resumed writer continues from
+        """
+        self._file.flush()
+        self._write_index()
+
+    def close(self):
+
+        self._file.close()
+        self._write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedClipStore():
+    """Read-only view over a packed store written by PackedClipWriter
+
+    The data file is memory-mapped lazily, so each DataLoader worker maps it on its own
+    and `read` returns a zero-copy view.
+    """
+    def __init__(self, store_dir):
+
+        self.store_dir = store_dir
+
+        with np.load(os.path.join(store_dir, INDEX_FILE)) as index:
+            self.keys = index['keys']
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+            self.dtype = np.dtype(str(index['dtype']))
+
+        self.key_to_id = {key: i for i, key in enumerate(self.keys)}
+
+        self._data = None
+        self._children = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, clip_key):
+        return clip_key in self.key_to_id
+
+    def __getstate__(self):
+        # Never pickle the memory map (it would be copied into every worker)
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.store_dir, DATA_FILE), dtype=self.dtype, mode='r')
+        return self._data
+
+    def read(self, clip_key):
+
+        if clip_key not in self.key_to_id:
+            raise KeyError(f"Clip {clip_key} is not in the packed store {self.store_dir}")
+
+        i = self.key_to_id[clip_key]
+        shape = tuple(self.shapes[i])
+        start = self.offsets[i]
+
+        return self.data[start:start + int(np.prod(shape))].reshape(shape)
+
+    def clips_of(self, video_key):
+        """
+        Clip keys stored under one video (clip_1, clip_2, ..) for the multi-clip layouts
+        """
+        if self._children is None:
+            self._children = {}
+            for key in self.keys:
+                self._children.setdefault(os.path.dirname(key), []).append(key)
+
+        return sorted(self._children.get(video_key, []), key=clip_sort_key)
+
+
+class ZipClipStore():
+    """Read the encoded frames of a clip straight out of a (downloaded) zip archive
+
+    The central directory is read once to index the member offsets per clip folder, then
+    every member is read with os.pread, so one store can be used by many forked workers.
+    Clip keys are folder paths relative to the common root folder inside the archive.
+    """
+    def __init__(self, zip_path):
+
+        self.zip_path = zip_path
+
+        with zipfile.ZipFile(zip_path) as archive:
+            infos = [info for info in archive.infolist()
+                     if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTS)]
+
+        if not infos:
+            raise ValueError(f"No image found in {zip_path}")
+
+        root = os.path.commonpath([os.path.dirname(info.filename) for info in infos])
+
+        self.members = {}   # clip key -> [(header offset, compressed size, compress type), ..]
+        for info in sorted(infos, key=lambda info: info.filename):
+            clip_key = os.path.relpath(os.path.dirname(info.filename), root)
+            self.members.setdefault(clip_key, []).append((info.header_offset, info.compress_size, info.compress_type))
+
+        self._fd = None
+        self._pid = None
+        self._children = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, clip_key):
+        return clip_key in self.members
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        return state
+
+    @property
+    def fd(self):
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.zip_path, os.O_RDONLY)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _read_member(self, header_offset, compress_size, compress_type):
+
+        # Local file header: 30 bytes, then the file name and the extra field
+        header = os.pread(self.fd, 30, header_offset)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+
+        data = os.pread(self.fd, compress_size, header_offset + 30 + name_length + extra_length)
+
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+
+        raise NotImplementedError(f"Unsupported compression {compress_type} in {self.zip_path}")
+
+    def read(self, clip_key):
+        """
+        Encoded bytes of every frame of the clip, in file name order
+        """
+        if clip_key not in self.members:
+            raise KeyError(f"Clip {clip_key} is not in the archive {self.zip_path}")
+
+        return [self._read_member(*member) for member in self.members[clip_key]]
+
+    def clips_of(self, video_key):
+        """
+        Clip keys stored under one video (clip_1, clip_2, ..) for the multi-clip layouts
+        """
+        if self._children is None:
+            self._children = {}
+            for key in self.members:
+                self._children.setdefault(os.path.dirname(key), []).append(key)
+
+        return sorted(self._children.get(video_key, []), key=clip_sort_key)
+
+
+class FrameCache():
+    """On-disk cache of preprocessed uint8 clips, one .npy file per clip under <cache_dir>/<namespace>/
+
+    Filled lazily on first access. Each clip is written to a temporary file then moved in place
+    with os.replace, so DataLoader workers (and concurrent runs) can share one cache and never
+    read a partial clip.
+    """
+    def __init__(self, cache_dir, namespace):
+        self.root = os.path.join(cache_dir, namespace)
+
+    def _path(self, clip_key):
+        name = hashlib.blake2b(clip_key.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.root, name[:2], name + '.npy')
+
+    def get(self, clip_key):
+        """
+        The cached clip, None on a miss
+        """
+        try:
+            return np.load(self._path(clip_key))
+        except FileNotFoundError:
+            return None
+
+    def put(self, clip_key, clip):
+
+        path = self._path(clip_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(clip))
+
+        os.replace(tmp_path, path)
+
+
+class SharedClipCache():
+    """LRU cache of decoded uint8 clips in shared memory, read and filled by every DataLoader worker
+
+    The clips live in n_slots fixed size slots of one shared memory segment, a second segment holds
+    the slot table (key digest, shape, last use), both guarded by one multiprocessing lock.
+    The creating process owns (and unlinks) the segments, workers attach to them by name when the
+    dataset is unpickled. Clips larger than a slot, or not uint8, are not cached.
+    """
+    MAX_DIMS = 4
+    TABLE_DTYPE = np.dtype([('key', np.uint64, (2,)),
+                            ('last_used', np.int64),     # 0: empty slot
+                            ('ndim', np.int64),
+                            ('shape', np.int64, (MAX_DIMS,))])
+
+    def __init__(self, size_gb, slot_bytes):
+
+        size = int(size_gb * 1024 ** 3)
+
+        # Writing past the size of /dev/shm kills the process with SIGBUS (small by default in docker)
+        if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free < size:
+            size = shutil.disk_usage('/dev/shm').free // 2
+            print(f"Not enough space in /dev/shm, the clip cache is reduced to {size / 1024 ** 3:.2f}GB")
+
+        self.slot_bytes = int(slot_bytes)
+        self.n_slots = max(size // self.slot_bytes, 1)
+        self.lock = multiprocessing.Lock()
+
+        self._data_shm = shared_memory.SharedMemory(create=True, size=self.n_slots * self.slot_bytes)
+        self._table_shm = shared_memory.SharedMemory(create=True, size=8 + self.n_slots * self.TABLE_DTYPE.itemsize)
+        self._owner = True
+        self._attach_views()
+
+        self._clock[0] = 0
+        self._table['last_used'] = 0
+
+        atexit.register(self.close)
+
+    def _attach_views(self):
+        self._clock = np.ndarray((1,), dtype=np.int64, buffer=self._table_shm.buf)
+        self._table = np.ndarray((self.n_slots,), dtype=self.TABLE_DTYPE, buffer=self._table_shm.buf, offset=8)
+        self._data = np.ndarray((self.n_slots, self.slot_bytes), dtype=np.uint8, buffer=self._data_shm.buf)
+
+    def __getstate__(self):
+        # Only the names of the segments, the workers attach to them
+        return {'slot_bytes': self.slot_bytes,
+                'n_slots': self.n_slots,
+                'lock': self.lock,
+                'data_name': self._data_shm.name,
+                'table_name': self._table_shm.name}
+
+    def __setstate__(self, state):
+        self.slot_bytes = state['slot_bytes']
+        self.n_slots = state['n_slots']
+        self.lock = state['lock']
+
+        self._data_shm = shared_memory.SharedMemory(name=state['data_name'])
+        self._table_shm = shared_memory.SharedMemory(name=state['table_name'])
+        self._owner = False
+        self._attach_views()
+
+    def __len__(self):
+        return int(np.count_nonzero(self._table['last_used']))
+
+    @staticmethod
+    def _digest(key):
+        return np.frombuffer(hashlib.blake2b(key.encode(), digest_size=16).digest(), dtype=np.uint64)
+
+    def _find(self, digest):
+        slots = np.flatnonzero((self._table['key'] == digest).all(axis=1) & (self._table['last_used'] > 0))
+        return int(slots[0]) if len(slots) else None
+
+    def _touch(self, slot):
+        self._clock[0] += 1
+        self._table['last_used'][slot] = self._clock[0]
+
+    def get(self, key):
+        """
+        A copy of the cached clip, None on a miss
+        """
+        digest = self._digest(key)
+
+        with self.lock:
+            slot = self._find(digest)
+            if slot is None:
+                return None
+
+            shape = tuple(self._table['shape'][slot][:self._table['ndim'][slot]])
+            clip = self._data[slot, :int(np.prod(shape))].reshape(shape).copy()
+            self._touch(slot)
+
+        return clip
+
+    def put(self, key, clip):
+        """
+        Store clip in an empty slot or in the least recently used one, False if it cannot be cached
+        """
+        if clip.dtype != np.uint8 or clip.nbytes > self.slot_bytes or clip.ndim > self.MAX_DIMS:
+            return False
+
+        digest = self._digest(key)
+
+        with self.lock:
+            if self._find(digest) is not None:
+                return True
+
+            slot = int(np.argmin(self._table['last_used']))
+
+            self._data[slot, :clip.nbytes] = np.ascontiguousarray(clip).reshape(-1)
+            self._table['key'][slot] = digest
+            self._table['ndim'][slot] = clip.ndim
+            self._table['shape'][slot][:clip.ndim] = clip.shape
+            self._touch(slot)
+
+        return True
+
+    def close(self):
+
+        if self._data_shm is None:
+            return
+
+        # The numpy views must go before the segments are closed
+        self._clock = self._table = self._data = None
+
+        for shm in (self._data_shm, self._table_shm):
+            shm.close()
+            if self._owner:
+                shm.unlink()
+
+        self._data_shm = self._table_shm = None
@@ -0,0 +1,276 @@
+#
+# Clip level transforms
+# Every transform works on a whole clip (T, H, W, C) at once and samples its random
+# parameters once per clip, so all frames of a clip get the same augmentation.
+#
+
+import math
+import random
+import hashlib
+
+import cv2
+import numpy as np
+import torch
+
+
+class ClipCompose():
+    """Compose several clip transforms
+
+    Example:
+    ```
+    transform = ClipCompose([Resize(112, 112), Normalize(), ToTensor()])
+    imgs = transform(clip)   # clip: (T, H, W, C) uint8 RGB -> imgs: (T, C, H, W) float32 tensor
+    ```
+    """
+    def __init__(self, transforms, reduced_decode=True):
+        self.transforms = transforms
+        self.reduced_decode = reduced_decode
+
+    @property
+    def deterministic(self):
+        return all(t.deterministic for t in self.transforms)
+
+    @property
+    def decode_size(self):
+        """
+        (height, width) the frames are resized to before anything else, the loader may decode
+        the JPEGs at a reduced scale down to this size. None when the first transform crops
+        (the crop may need the full resolution) or with reduced_decode=False
+        """
+        if self.reduced_decode and self.transforms and isinstance(self.transforms[0], Resize):
+            return self.transforms[0].height, self.transforms[0].width
+        return None
+
+    @property
+    def cache_steps(self):
+        """
+        Number of leading transforms whose output can be cached on disk: the leading Resize of a
+        deterministic pipeline (uint8 frames, the same every epoch), 0 for random pipelines
+        """
+        if self.deterministic and self.transforms and isinstance(self.transforms[0], Resize):
+            return 1
+        return 0
+
+    @property
+    def cache_key(self):
+        """
+        Hash of the cached transforms and of the decode mode, None when nothing can be cached
+        """
+        if not self.cache_steps:
+            return None
+
+        config = '{} reduced_decode={}'.format(self.transforms[:self.cache_steps], self.reduced_decode)
+        return hashlib.blake2b(config.encode(), digest_size=16).hexdigest()
+
+    def __call__(self, clip, start=0, stop=None):
+        # start / stop: run only part of the pipeline (e.g. the rest of it on a cached clip)
+        for t in self.transforms[start:stop]:
+            clip = t(clip)
+        return clip
+
+    def __repr__(self):
+        return 'ClipCompose([{}])'.format(', '.join(repr(t) for t in self.transforms))
+
+
+class ClipTransform():
+    """
+    Base class, `deterministic` is False for the random augmentations
+    """
+    deterministic = True
+
+    def __repr__(self):
+        params = ', '.join(f'{k}={v}' for k, v in sorted(vars(self).items()))
+        return f'{self.__class__.__name__}({params})'
+
+
+def _resize_clip(clip, height, width, interpolation):
+
+    out = np.empty((clip.shape[0], height, width) + clip.shape[3:], dtype=clip.dtype)
+
+    # One cv2 call per frame into a single preallocated clip
+    # (a multi-channel resize of the whole (H, W, T * C) stack is far slower in OpenCV)
+    for i, frame in enumerate(clip):
+        out[i] = cv2.resize(np.ascontiguousarray(frame), (width, height), interpolation=interpolation)
+
+    return out
+
+
+class Resize(ClipTransform):
+
+    def __init__(self, height, width, interpolation=cv2.INTER_CUBIC):
+        self.height = height
+        self.width = width
+        self.interpolation = interpolation
+
+    def __call__(self, clip):
+        return _resize_clip(clip, self.height, self.width, self.interpolation)
+
+
+class CenterCrop(ClipTransform):
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+
+    def __call__(self, clip):
+        _, h, w = clip.shape[:3]
+        top = max((h - self.height) // 2, 0)
+        left = max((w - self.width) // 2, 0)
+        return clip[:, top:top + self.height, left:left + self.width]
+
+
+class RandomResizedCrop(ClipTransform):
+    """
+    Same crop sampling as A.RandomResizedCrop, one crop for the whole clip
+    """
+    deterministic = False
+
+    def __init__(self, height, width, scale=(0.08, 1.0), ratio=(0.75, 1.3333333333333333),
+                 interpolation=cv2.INTER_CUBIC):
+        self.height = height
+        self.width = width
+        self.scale = scale
+        self.ratio = ratio
+        self.interpolation = interpolation
+
+    def _get_crop(self, h, w):
+
+        area = h * w
+
+        for _ in range(10):
+            target_area = random.uniform(*self.scale) * area
+            aspect_ratio = math.exp(random.uniform(math.log(self.ratio[0]), math.log(self.ratio[1])))
+
+            crop_w = int(round(math.sqrt(target_area * aspect_ratio)))
+            crop_h = int(round(math.sqrt(target_area / aspect_ratio)))
+
+            if 0 < crop_w <= w and 0 < crop_h <= h:
+                top = random.randint(0, h - crop_h)
+                left = random.randint(0, w - crop_w)
+                return top, left, crop_h, crop_w
+
+        # Fallback to central crop
+        in_ratio = w / h
+        if in_ratio < min(self.ratio):
+            crop_w = w
+            crop_h = int(round(w / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            crop_h = h
+            crop_w = int(round(h * max(self.ratio)))
+        else:
+            crop_w, crop_h = w, h
+
+        return (h - crop_h) // 2, (w - crop_w) // 2, crop_h, crop_w
+
+    def __call__(self, clip):
+        top, left, crop_h, crop_w = self._get_crop(*clip.shape[1:3])
+        clip = clip[:, top:top + crop_h, left:left + crop_w]
+        return _resize_clip(clip, self.height, self.width, self.interpolation)
+
+
+class HorizontalFlip(ClipTransform):
+    deterministic = False
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, clip):
+        return clip[:, :, ::-1] if random.random() < self.p else clip
+
+
+class VerticalFlip(ClipTransform):
+    deterministic = False
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, clip):
+        return clip[:, ::-1] if random.random() < self.p else clip
+
+
+class ColorJitter(ClipTransform):
+    """
+    Random brightness, contrast, saturation and hue (same ranges as A.ColorJitter),
+    one set of factors for the whole clip
+    """
+    deterministic = False
+
+    def __init__(self, brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2, p=0.5):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.p = p
+
+    def __call__(self, clip):
+
+        if random.random() >= self.p:
+            return clip
+
+        brightness = random.uniform(max(0, 1 - self.brightness), 1 + self.brightness)
+        contrast = random.uniform(max(0, 1 - self.contrast), 1 + self.contrast)
+        saturation = random.uniform(max(0, 1 - self.saturation), 1 + self.saturation)
+        hue = random.uniform(-self.hue, self.hue)
+
+        t, h, w, c = clip.shape
+        clip = clip.astype(np.float32) * brightness
+
+        gray = clip @ np.array([0.299, 0.587, 0.114], dtype=np.float32)    # (T, H, W)
+        mean = gray.mean(axis=(1, 2)).reshape(t, 1, 1, 1)
+        clip = (clip - mean) * contrast + mean
+
+        gray = (clip @ np.array([0.299, 0.587, 0.114], dtype=np.float32))[..., None]
+        clip = (clip - gray) * saturation + gray
+
+        clip = np.clip(clip, 0, 255).astype(np.uint8)
+
+        if hue:
+            # The whole clip as one (T * H, W, 3) image: one color conversion each way
+            hsv = cv2.cvtColor(np.ascontiguousarray(clip).reshape(t * h, w, c), cv2.COLOR_RGB2HSV)
+            hsv[..., 0] = (hsv[..., 0].astype(np.int16) + int(round(hue * 180))) % 180
+            clip = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB).reshape(t, h, w, c)
+
+        return clip
+
+
+class Normalize(ClipTransform):
+    """
+    (clip - mean * 255) / (std * 255) as A.Normalize(), float32 output
+    """
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), max_pixel_value=255.0):
+        self.mean = mean
+        self.std = std
+        self.max_pixel_value = max_pixel_value
+
+    def __call__(self, clip):
+        mean = np.array(self.mean, dtype=np.float32) * self.max_pixel_value
+        std = np.array(self.std, dtype=np.float32) * self.max_pixel_value
+
+        t, h, w, c = clip.shape
+
+        # The clip as one (T * H, W, C) image: per channel scalars are much faster in cv2 than numpy broadcasting
+        clip = np.ascontiguousarray(clip).reshape(t * h, w, c).astype(np.float32)
+        clip = cv2.subtract(clip, tuple(mean.tolist()) + (0.0,) * (4 - c))
+        clip = cv2.multiply(clip, tuple((1.0 / std).tolist()) + (0.0,) * (4 - c))
+
+        return clip.reshape(t, h, w, c)
+
+
+class ToTensor(ClipTransform):
+    """
+    (T, H, W, C) numpy -> (T, C, H, W) tensor, the dtype is kept (uint8 without Normalize)
+    contiguous=False: a permuted view without copy, for a collate that copies it into the batch anyway
+    """
+    def __init__(self, contiguous=True):
+        self.contiguous = contiguous
+
+    def __call__(self, clip):
+
+        if self.contiguous:
+            return torch.from_numpy(np.ascontiguousarray(clip.transpose(0, 3, 1, 2)))
+
+        # torch has no negative strides (flipped clips)
+        if any(stride < 0 for stride in clip.strides):
+            clip = clip.copy()
+
+        return torch.from_numpy(clip).permute(0, 3, 1, 2)
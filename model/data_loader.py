@@ -1,63 +1,258 @@
 import os
+import struct
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
 import cv2
-import albumentations as A
 
 from sklearn import model_selection
 
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, get_worker_info
+
+from .clip_store import PackedClipStore, ZipClipStore, FrameCache, SharedClipCache, clip_sort_key
+from .manifest import ClipManifest, get_manifest_path
+from .video_reader import VideoReaderPool, sample_frame_indices, sample_clip_indices
+from .loader_autotune import autotune_loader, get_default_config, get_loader_kwargs
+
+
+JPEG_HEADER_BYTES = 65536   # read to find the frame size, EXIF thumbnails included
+
+# Start of frame markers (baseline, progressive, ..) hold the image height and width
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+_REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                         (4, cv2.IMREAD_REDUCED_COLOR_4),
+                         (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+_DECODE_THREAD = threading.local()   # set in the decode pool threads
+
+
+def _mark_decode_thread():
+    _DECODE_THREAD.active = True
+
+
+def jpeg_size(buf):
+    """
+    (height, width) from the header of an encoded JPEG, None if buf is not a JPEG
+    or its start of frame is not in buf
+    """
+    if buf[:2] != b'\xff\xd8':
+        return None
+
+    i = 2
+    while i + 9 <= len(buf):
+
+        if buf[i] != 0xFF:
+            return None
+
+        marker = buf[i + 1]
+
+        if marker == 0xFF:      # fill byte
+            i += 1
+        elif marker in _JPEG_SOF_MARKERS:
+            return struct.unpack('>HH', buf[i + 5:i + 9])
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:     # markers without payload
+            i += 2
+        else:
+            i += 2 + struct.unpack('>H', buf[i + 2:i + 4])[0]
+
+    return None
+
+
+def get_decode_flag(header, decode_size):
+    """
+    cv2 imread flag for a JPEG whose frames end up resized to decode_size (height, width):
+    the largest IMREAD_REDUCED_COLOR_2/4/8 scale that keeps the decoded frames at least that large
+    (libjpeg then skips most of the IDCT work), IMREAD_COLOR otherwise
+    """
+    if decode_size is None:
+        return cv2.IMREAD_COLOR
+
+    size = jpeg_size(header)
+    if size is None:
+        return cv2.IMREAD_COLOR
+
+    (h, w), (out_h, out_w) = size, decode_size
+
+    for scale, flag in _REDUCED_DECODE_FLAGS:
+        if h // scale >= out_h and w // scale >= out_w:
+            return flag
+
+    return cv2.IMREAD_COLOR
 
 
 class ActionRecognitionDataset(Dataset):
     """
     Dataset class for training and validation stage
     """
-    def __init__(self, data_dir, df_train_test_split, transform):
+    def __init__(self, data_dir, clip_paths, labels, transform, manifest=None, cache_dir=None):
 
         self.data_dir = data_dir
         self.transform = transform
-        self.df = df_train_test_split
+
+        # Plain arrays (no pandas in the workers)
+        self.clip_paths = np.asarray(clip_paths, dtype=str)
+        self.labels = np.asarray(labels, dtype=np.int64)
+
+        # Frame files of every clip (see model/manifest.py), listed on the fly without it
+        self.manifest = manifest
+
+        # Resized uint8 clips cached on disk, per data_dir and transform configuration (none for random pipelines)
+        cache_key = getattr(transform, 'cache_key', None)
+        if cache_dir and cache_key is not None:
+            namespace = hashlib.blake2b(f'{os.path.abspath(data_dir)} {cache_key}'.encode(), digest_size=8).hexdigest()
+            self.frame_cache = FrameCache(cache_dir, namespace)
+        else:
+            self.frame_cache = None
+
+        # Shared memory LRU cache of the decoded clips (--cache_gb), set by ActionRecognitionDataWrapper
+        self.clip_cache = None
+
+        # Threads decoding the frames of a clip (--decode_threads), set by ActionRecognitionDataWrapper
+        self.decode_threads = 0
+        self._decode_pool = None
+        self._decode_pool_pid = None
 
     def __len__(self):
-        return len(self.df)
+        return len(self.clip_paths)
+
+    def __getstate__(self):
+        # Every worker starts its own decode pool
+        state = self.__dict__.copy()
+        state['_decode_pool'] = None
+        return state
+
+    @property
+    def decode_pool(self):
+        """
+        Thread pool of this process (cv2.imread / cv2.imdecode release the GIL), None when decode_threads is 0
+        """
+        if not self.decode_threads:
+            return None
+
+        if self._decode_pool is None or self._decode_pool_pid != os.getpid():
+            self._decode_pool = ThreadPoolExecutor(self.decode_threads, initializer=_mark_decode_thread)
+            self._decode_pool_pid = os.getpid()
+
+        return self._decode_pool
+
+    def _map_decode(self, fn, items):
+        """
+        [fn(item) for item in items] on the decode pool, in order (in the calling thread without pool,
+        or when already called from a pool thread: the clips of a test video are decoded in parallel)
+        """
+        if self.decode_pool is None or getattr(_DECODE_THREAD, 'active', False):
+            return [fn(item) for item in items]
+
+        return list(self.decode_pool.map(fn, items))
 
     def _get_full_path(self, video_folder_path):
         return os.path.join(self.data_dir, video_folder_path)
 
-    def _read_image(self, image_path, data_replay):
+    @property
+    def decode_size(self):
+        """
+        Size the frames are resized to first (see ClipCompose.decode_size), None: decode at full resolution
+        """
+        return getattr(self.transform, 'decode_size', None)
 
-        img = cv2.imread(image_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def _read_image(self, image_path, flag=cv2.IMREAD_COLOR):
 
-        if self.transform is not None:
-            img = A.ReplayCompose.replay(data_replay, image=img)['image']
+        img = cv2.imread(image_path, flag)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         return img
 
+    def _list_frames(self, folder_path):
+
+        if self.manifest is not None:
+            return self.manifest.frames_of(os.path.relpath(folder_path, self.data_dir))
+
+        return sorted(os.listdir(folder_path))
+
+    def _load_frames(self, folder_path):
+        """
+        Decoded RGB frames (uint8) of one clip in temporal order
+        """
+        lst_imgs = [os.path.join(folder_path, path) for path in self._list_frames(folder_path)]
+
+        # The frames of a clip share their size: one header read picks the decode scale for all of them
+        flag = cv2.IMREAD_COLOR
+        if lst_imgs and self.decode_size is not None:
+            with open(lst_imgs[0], 'rb') as f:
+                flag = get_decode_flag(f.read(JPEG_HEADER_BYTES), self.decode_size)
+
+        return self._map_decode(lambda path: self._read_image(path, flag), lst_imgs)
+
+    @property
+    def cache_steps(self):
+        """
+        Number of leading transforms applied before a clip is cached (the resize of a deterministic pipeline)
+        """
+        return getattr(self.transform, 'cache_steps', 0)
+
     def _read_one_clip(self, folder_path):
 
-        lst_imgs = sorted(os.listdir(folder_path))
+        if self.frame_cache is None and self.clip_cache is None:
+            return self._transform_clip(self._load_frames(folder_path))
 
-        data_replay = None
+        # Frames are decoded (and resized) once, later epochs only run the rest of the pipeline
+        return self._transform_clip(self._load_cached_clip(folder_path), start=self.cache_steps)
 
-        if self.transform is not None:
-            # Read the first img
-            first_img = cv2.imread(os.path.join(folder_path, lst_imgs[0]))
-            first_img = cv2.cvtColor(first_img, cv2.COLOR_BGR2RGB)
-            data_replay = self.transform(image=first_img)['replay']
+    def _decode_clip(self, folder_path):
+        """
+        (T, H, W, C) uint8 clip after the cache_steps first transforms
+        """
+        clip = self._stack_frames(self._load_frames(folder_path))
+        return self.transform(clip, stop=self.cache_steps) if self.cache_steps else clip
+
+    def _load_cached_clip(self, folder_path):
+        """
+        _decode_clip from the shared memory cache, else from the disk cache, else from the frames
+        """
+        memory_key = f'{getattr(self.transform, "cache_key", None)} {folder_path}'
+
+        if self.clip_cache is not None:
+            clip = self.clip_cache.get(memory_key)
+            if clip is not None:
+                return clip
+
+        clip = self.frame_cache.get(folder_path) if self.frame_cache is not None else None
+
+        if clip is None:
+            clip = self._decode_clip(folder_path)
+            if self.frame_cache is not None:
+                self.frame_cache.put(folder_path, clip)
 
-        imgs = torch.stack([self._read_image(os.path.join(folder_path, path), data_replay) for path
-                            in lst_imgs],
-                           dim=0)
+        if self.clip_cache is not None:
+            self.clip_cache.put(memory_key, clip)
 
-        return imgs
+        return clip
+
+    @staticmethod
+    def _stack_frames(frames):
+        # One (T, H, W, C) array, the packed store already returns one
+        return np.stack(frames, axis=0) if isinstance(frames, list) else frames
+
+    def _transform_clip(self, frames, start=0):
+
+        clip = self._stack_frames(frames)
+
+        if self.transform is None:
+            return torch.from_numpy(np.array(clip))
+
+        # Clip level transform: same random parameters for every frame of the clip
+        return self.transform(clip, start=start) if start else self.transform(clip)
 
     def __getitem__(self, idx):
 
-        clip_path, _, label = self.df.iloc[idx]
+        clip_path, label = self.clip_paths[idx], self.labels[idx]
 
         full_clip_path = self._get_full_path(clip_path)
 
@@ -73,13 +268,27 @@ class ActionRecognitionDatasetTest(ActionRecognitionDataset):
     Dataset class for test stage
     """
 
-    def __init__(self, data_dir, df_train_test_split, transform, clip_per_video):
-        super().__init__(data_dir, df_train_test_split, transform)
+    def __init__(self, data_dir, clip_paths, labels, transform, clip_per_video, manifest=None, cache_dir=None):
+        super().__init__(data_dir, clip_paths, labels, transform, manifest, cache_dir)
         self.clip_per_video = clip_per_video
 
+        # False: the clips of a video are returned as a list and stacked by ClipCollator straight into the batch
+        self.stack_clips = True
+
+    def _stack_clips(self, clips):
+        return torch.stack(clips, dim=0) if self.stack_clips else clips
+
+    def _list_clips(self, video_path):
+
+        if self.manifest is not None:
+            return [self._get_full_path(path) for path in
+                    self.manifest.clips_of(os.path.relpath(video_path, self.data_dir))]
+
+        return [os.path.join(video_path, path) for path in sorted(os.listdir(video_path), key=clip_sort_key)]
+
     def __getitem__(self, idx):
 
-        video_path, _, label = self.df.iloc[idx]
+        video_path, label = self.clip_paths[idx], self.labels[idx]
 
         video_path = self._get_full_path(video_path)
 
@@ -88,14 +297,317 @@ class ActionRecognitionDatasetTest(ActionRecognitionDataset):
             imgs = self._read_one_clip(clip_path)
 
         else:
-            clip_paths = os.listdir(video_path)
-            imgs = torch.stack([self._read_one_clip(os.path.join(video_path, path)) for path in clip_paths],
-                               dim=0)
+            clip_paths = self._list_clips(video_path)
+            imgs = self._stack_clips(self._map_decode(self._read_one_clip, clip_paths))
+
+        label = torch.tensor(label).long()
+        return imgs, label
+
+
+class PackedClipMixin():
+    """
+    Read clips from a packed store (see model/clip_store.py) instead of per-JPEG folders.
+    data_dir is the store folder and clips are addressed by their relative folder path.
+    """
+    @property
+    def store(self):
+        if getattr(self, '_store', None) is None:
+            self._store = PackedClipStore(self.data_dir)
+        return self._store
+
+    def _get_full_path(self, video_folder_path):
+        return video_folder_path
+
+    def _load_frames(self, clip_key):
+        return self.store.read(clip_key)
+
+    def _list_clips(self, video_key):
+        return self.store.clips_of(video_key)
+
+
+class ActionRecognitionPackedDataset(PackedClipMixin, ActionRecognitionDataset):
+    """
+    Dataset class for training and validation stage on a packed store
+    """
+
+
+class ActionRecognitionPackedDatasetTest(PackedClipMixin, ActionRecognitionDatasetTest):
+    """
+    Dataset class for test stage on a packed store
+    """
+
+
+class FeatureClipMixin(PackedClipMixin):
+    """
+    Read precomputed ResNet152 features (T, 2048) from a feature store (see extract_features.py).
+    Frames are never decoded, so transforms are not applied.
+    """
+    def _read_one_clip(self, clip_key):
+        return torch.from_numpy(np.array(self.store.read(clip_key)))
+
+
+class ActionRecognitionFeatureDataset(FeatureClipMixin, ActionRecognitionDataset):
+    """
+    Dataset class for training and validation stage on a feature store
+    """
+
+
+class ActionRecognitionFeatureDatasetTest(FeatureClipMixin, ActionRecognitionDatasetTest):
+    """
+    Dataset class for test stage on a feature store
+    """
+
+
+class VideoClipMixin():
+    """
+    Decode clips straight from the raw videos <data_dir>/<video_folder_path>.avi,
+    sampling a new clip (sample_type) every time a video is read.
+    """
+    video_ext = '.avi'
+
+    @property
+    def video_pool(self):
+        if getattr(self, '_video_pool', None) is None:
+            self._video_pool = VideoReaderPool()
+        return self._video_pool
+
+    def _get_full_path(self, video_folder_path):
+        return os.path.join(self.data_dir, video_folder_path + self.video_ext)
+
+    def _load_frames(self, video_path):
+        reader = self.video_pool.get(video_path)
+        return reader.read(sample_frame_indices(reader.frame_count, self.sample_type))
+
+
+class ActionRecognitionVideoDataset(VideoClipMixin, ActionRecognitionDataset):
+    """
+    Dataset class for training and validation stage on raw videos
+    clip_per_video > 1: the clip paths are <video>/clip_k (as in the 5_clips_16_frames layout),
+    read as the k-th of clip_per_video evenly spaced clips of 16 consecutive frames
+    """
+    def __init__(self, data_dir, clip_paths, labels, transform, sample_type='16_frames_conse_rand', clip_per_video=1):
+        super().__init__(data_dir, clip_paths, labels, transform)
+        self.sample_type = sample_type
+        self.clip_per_video = clip_per_video
+
+    def __getitem__(self, idx):
+
+        if self.clip_per_video <= 1:
+            return super().__getitem__(idx)
+
+        clip_path, label = self.clip_paths[idx], self.labels[idx]
+        video_path, clip_name = os.path.split(clip_path)
+
+        reader = self.video_pool.get(self._get_full_path(video_path))
+
+        clip_indices = sample_clip_indices(reader.frame_count, self.clip_per_video)[int(clip_name[len('clip_'):]) - 1]
+        imgs = self._transform_clip(reader.read(clip_indices))
 
         label = torch.tensor(label).long()
         return imgs, label
 
 
+class ActionRecognitionVideoDatasetTest(VideoClipMixin, ActionRecognitionDatasetTest):
+    """
+    Dataset class for test stage on raw videos
+    clip_per_video > 1: evenly spaced clips of 16 consecutive frames, decoded in one pass
+    """
+    def __init__(self, data_dir, clip_paths, labels, transform, clip_per_video,
+                 sample_type='16_frames_conse_rand'):
+        super().__init__(data_dir, clip_paths, labels, transform, clip_per_video)
+        self.sample_type = sample_type
+
+    def __getitem__(self, idx):
+
+        if self.clip_per_video <= 1:
+            return super().__getitem__(idx)
+
+        video_path, label = self.clip_paths[idx], self.labels[idx]
+
+        reader = self.video_pool.get(self._get_full_path(video_path))
+
+        clip_indices = sample_clip_indices(reader.frame_count, self.clip_per_video)
+        frames = reader.read([index for indices in clip_indices for index in indices])
+
+        clip_len = len(clip_indices[0])
+        imgs = self._stack_clips([self._transform_clip(frames[i:i + clip_len]) for i in range(0, len(frames), clip_len)])
+
+        label = torch.tensor(label).long()
+        return imgs, label
+
+
+_ZIP_STORES = {}   # one index per archive and per process, shared by train / val / test
+
+
+class ZipClipMixin():
+    """
+    Read clips straight out of the downloaded zip archive (data_dir is the .zip file),
+    frames are decoded with cv2.imdecode from the member bytes.
+    """
+    @property
+    def store(self):
+        if self.data_dir not in _ZIP_STORES:
+            _ZIP_STORES[self.data_dir] = ZipClipStore(self.data_dir)
+        return _ZIP_STORES[self.data_dir]
+
+    def _get_full_path(self, video_folder_path):
+        return video_folder_path
+
+    def _decode_image(self, buf, flag=cv2.IMREAD_COLOR):
+        img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flag)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def _load_frames(self, clip_key):
+
+        bufs = self.store.read(clip_key)
+        flag = get_decode_flag(bufs[0], self.decode_size) if bufs else cv2.IMREAD_COLOR
+
+        return self._map_decode(lambda buf: self._decode_image(buf, flag), bufs)
+
+    def _list_clips(self, video_key):
+        return self.store.clips_of(video_key)
+
+
+class ActionRecognitionZipDataset(ZipClipMixin, ActionRecognitionDataset):
+    """
+    Dataset class for training and validation stage on a zip archive
+    """
+
+
+class ActionRecognitionZipDatasetTest(ZipClipMixin, ActionRecognitionDatasetTest):
+    """
+    Dataset class for test stage on a zip archive
+    """
+
+
+class ResumableRandomSampler(Sampler):
+    """Random order like shuffle=True, but the order of an epoch only depends on (seed, epoch)
+    and the position in the epoch can be saved in a checkpoint and restored
+
+    Example:
+    ```
+    sampler.set_epoch(epoch)
+    state = sampler.state_dict(step * batch_size)   # after step batches
+    ...
+    sampler.load_state_dict(state)                  # the next iteration starts at the next batch
+    ```
+    """
+    def __init__(self, num_samples, seed=73):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0       # samples of the epoch already seen (resumed run)
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.start = 0
+
+    def state_dict(self, position=0):
+        return {'seed': self.seed, 'epoch': self.epoch, 'position': position}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start = state['position']
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def __iter__(self):
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        order = torch.randperm(self.num_samples, generator=generator)[self.start:].tolist()
+        self.start = 0
+
+        return iter(order)
+
+
+class ClipCollator():
+    """Collate fixed shape clips into a ring of preallocated batch buffers
+
+    Every clip (or list of clips of a test video) is copied once, straight into its row of the batch.
+    Inside a DataLoader worker the buffers are in shared memory, so a batch reaches the main process
+    without a new shared memory segment per batch; in the main process (num_workers=0) they can be pinned.
+    A buffer is written again ring_size batches later, so ring_size must exceed the number of batches
+    alive at once (see get_ring_size).
+    """
+    def __init__(self, ring_size, pin_memory=False):
+        self.ring_size = ring_size
+        self.pin_memory = pin_memory
+
+        self._buffers = []
+        self._next = 0
+
+    def __getstate__(self):
+        # Each worker allocates its own ring
+        state = self.__dict__.copy()
+        state['_buffers'] = []
+        state['_next'] = 0
+        return state
+
+    def _allocate(self, shape, dtype):
+
+        if get_worker_info() is not None:
+            return torch.empty(shape, dtype=dtype).share_memory_()
+
+        return torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory and torch.cuda.is_available())
+
+    def _get_buffer(self, batch_size, sample_shape, dtype):
+
+        shape = (batch_size,) + tuple(sample_shape)
+        i = self._next % self.ring_size
+        self._next += 1
+
+        if i == len(self._buffers):
+            self._buffers.append(self._allocate(shape, dtype))
+
+        buffer = self._buffers[i]
+        if buffer.shape[1:] != shape[1:] or buffer.dtype != dtype or len(buffer) < batch_size:
+            buffer = self._buffers[i] = self._allocate(shape, dtype)
+
+        # The last batch of an epoch may be smaller
+        return buffer[:batch_size]
+
+    def __call__(self, batch):
+
+        clips, labels = zip(*batch)
+
+        first = clips[0]
+        if isinstance(first, list):
+            out = self._get_buffer(len(batch), (len(first),) + tuple(first[0].shape), first[0].dtype)
+        else:
+            out = self._get_buffer(len(batch), first.shape, first.dtype)
+
+        for i, clip in enumerate(clips):
+            if isinstance(clip, list):
+                for j, one_clip in enumerate(clip):
+                    out[i, j].copy_(one_clip)
+            else:
+                out[i].copy_(clip)
+
+        return out, torch.stack(labels)
+
+
+def get_ring_size(num_workers, prefetch_factor, prefetch_batches):
+    """
+    ClipCollator buffers of one producer: the batches it has queued or is building (prefetch_factor
+    per worker, the batch being collated in the main process with num_workers=0), the ones staged
+    by a BatchPrefetcher, the one in use and the previous one (pinned non_blocking copies may still read it)
+    """
+    in_flight = prefetch_factor if num_workers > 0 else 1
+    return in_flight + prefetch_batches + 2
+
+
+DATASET_CLASSES = {'frames': (ActionRecognitionDataset, ActionRecognitionDatasetTest),
+                   'packed': (ActionRecognitionPackedDataset, ActionRecognitionPackedDatasetTest),
+                   'features': (ActionRecognitionFeatureDataset, ActionRecognitionFeatureDatasetTest),
+                   'video': (ActionRecognitionVideoDataset, ActionRecognitionVideoDatasetTest),
+                   'zip': (ActionRecognitionZipDataset, ActionRecognitionZipDatasetTest)}
+
+
 class ActionRecognitionDataWrapper():
     """
     Class for generating dataloader for train, validation, and test set
@@ -108,6 +620,15 @@ class ActionRecognitionDataWrapper():
                  batch_size,
                  num_workers,
                  clip_per_video,
+                 data_format='frames',
+                 sample_type='16_frames_conse_rand',
+                 cache_dir='',
+                 cache_gb=0,
+                 autotune=False,
+                 device=None,
+                 ring_collate=False,
+                 prefetch_batches=0,
+                 decode_threads=0,
                  *args,
                  **kwargs):
 
@@ -118,39 +639,138 @@ class ActionRecognitionDataWrapper():
         self.num_workers = num_workers
         self.split = data_split
         self.clip_per_video = clip_per_video
+        # A .zip data_dir is read in place (no need to unzip the downloaded dataset)
+        self.data_format = 'zip' if data_format == 'frames' and data_dir.endswith('.zip') else data_format
+        self.sample_type = sample_type
+        self.cache_dir = cache_dir
+        self.cache_gb = cache_gb
+        self.ring_collate = ring_collate
+        self.prefetch_batches = prefetch_batches   # batches held ahead by a BatchPrefetcher (see utils.py)
+        self.decode_threads = decode_threads
+
+        # DataLoader knobs (workers, threads per worker, prefetch, pinned memory) probed on this machine,
+        # per split on first use (see get_loader_config)
+        self.autotune = autotune
+        self.device = torch.device(device or 'cpu')
+        self._loader_configs = {}
 
         self._setup()
 
     def _setup(self):
 
-        df_anno_train_val, df_anno_test = self._get_annotation_pandas()
+        manifest = self._get_manifest()
 
-        # Train, Val
-        df_train_val = df_anno_train_val[['video_folder_path', self.split, 'label_id']]
+        if manifest is not None:
+            train_val_paths, train_val_labels, test_paths, test_labels = self._get_annotation_manifest(manifest)
+        else:
+            train_val_paths, train_val_labels, test_paths, test_labels = self._get_annotation_pandas()
 
-        df_train, df_val = model_selection.train_test_split(df_train_val,
-                                                            train_size=0.8,
-                                                            stratify=df_train_val['label_id'])
+        # Train, Val
+        train_paths, val_paths, train_labels, val_labels = model_selection.train_test_split(train_val_paths,
+                                                                                           train_val_labels,
+                                                                                           train_size=0.8,
+                                                                                           stratify=train_val_labels)
+
+        dataset_class, dataset_test_class = DATASET_CLASSES[self.data_format]
+
+        # Raw videos are sampled on the fly
+        dataset_kwargs = {'sample_type': self.sample_type} if self.data_format == 'video' else {}
+        if manifest is not None:
+            dataset_kwargs['manifest'] = manifest
+        # Decoded frames can be cached (raw videos are sampled anew every epoch, features are not frames)
+        if self.cache_dir and self.data_format in ('frames', 'packed', 'zip'):
+            dataset_kwargs['cache_dir'] = self.cache_dir
+
+        # Raw videos have no clip folders: clip_k is cut from the video itself
+        train_kwargs = {'clip_per_video': self.clip_per_video} if self.data_format == 'video' else {}
+
+        self.train = dataset_class(self.data_dir,
+                                   train_paths,
+                                   train_labels,
+                                   self.transforms['train_transforms'],
+                                   **dataset_kwargs,
+                                   **train_kwargs)
+
+        self.val = dataset_class(self.data_dir,
+                                 val_paths,
+                                 val_labels,
+                                 self.transforms['val_transforms'],
+                                 **dataset_kwargs,
+                                 **train_kwargs)
 
         # Test
-        df_test = df_anno_test[['video_folder_path', self.split, 'label_id']]
+        self.test = dataset_test_class(self.data_dir,
+                                       test_paths,
+                                       test_labels,
+                                       self.transforms['test_transforms'],
+                                       self.clip_per_video,
+                                       **dataset_kwargs)
+
+        # Frames (test: clips) of an item decoded by a small thread pool in each worker
+        for dataset in (self.train, self.val, self.test):
+            dataset.decode_threads = self.decode_threads
+
+        # ClipCollator stacks the clips of a test video into the batch itself
+        if self.ring_collate:
+            self.test.stack_clips = False
+
+        # Decoded clips shared by all the workers of the train, val and test loaders
+        if self.cache_gb > 0 and self.data_format in ('frames', 'packed', 'zip'):
+            self._setup_clip_cache()
+
+    def _setup_clip_cache(self):
+        """
+        One shared memory LRU cache of cache_gb for the three datasets, its slots are sized from a training clip
+        (with some margin for the videos of another resolution, larger clips are simply not cached)
+        """
+        probe = self.train._decode_clip(self.train._get_full_path(self.train.clip_paths[0]))
+        slot_bytes = -(-int(probe.nbytes * 1.25) // 4096) * 4096
+
+        clip_cache = SharedClipCache(self.cache_gb, slot_bytes)
+        print(f"Shared memory clip cache: {clip_cache.n_slots} clips of up to {slot_bytes / 1024 ** 2:.1f}MB")
+
+        for dataset in (self.train, self.val, self.test):
+            dataset.clip_cache = clip_cache
+
+    def _get_manifest(self):
+        """
+        Manifest of the frame folder if it was built (build_dataset.py --manifest)
+        """
+        if self.data_format != 'frames':
+            return None
+
+        manifest_path = get_manifest_path(self.dataset, self.data_dir)
+
+        if not os.path.exists(manifest_path):
+            return None
+
+        manifest = ClipManifest.load(manifest_path)
+
+        if manifest.is_stale(self.data_dir):
+            print(f"The clip manifest {manifest_path} is older than {self.data_dir}, listing the frame folders instead "
+                  f"(rebuild it with build_dataset.py --manifest)")
+            return None
 
-        self.train = ActionRecognitionDataset(self.data_dir,
-                                              df_train,
-                                              self.transforms['train_transforms'])
+        print(f"Load the clip manifest {manifest_path}")
+        return manifest
 
-        self.val = ActionRecognitionDataset(self.data_dir,
-                                            df_val,
-                                            self.transforms['val_transforms'])
+    def _get_annotation_manifest(self, manifest):
+        """
+        Same as _get_annotation_pandas from the precomputed arrays
+        """
+        train_val_ids = manifest.get_split(self.split, 'train')
+        test_ids = manifest.get_split(self.split, 'test')
 
-        self.test = ActionRecognitionDatasetTest(self.data_dir,
-                                                 df_test,
-                                                 self.transforms['test_transforms'],
-                                                 self.clip_per_video)
+        if self.clip_per_video > 1:
+            train_val_paths, train_val_labels = manifest.get_clips(train_val_ids, self.clip_per_video)
+        else:
+            train_val_paths, train_val_labels = manifest.video_paths[train_val_ids], manifest.labels[train_val_ids]
+
+        return train_val_paths, train_val_labels, manifest.video_paths[test_ids], manifest.labels[test_ids]
 
     def _get_annotation_pandas(self):
         """
-        Get df based on number of clips per video
+        Get clip paths and labels based on number of clips per video
         start from clip_1, clip_2, .. (if self.clip_per_video > 1)
         or default
 
@@ -173,13 +793,43 @@ class ActionRecognitionDataWrapper():
             train_val_df = train_val_df.explode('video_folder_path').reset_index()
             del train_val_df['index']  # reset index
 
-        return train_val_df, test_df
+        return (train_val_df['video_folder_path'].to_numpy(dtype=str), train_val_df['label_id'].to_numpy(dtype=np.int64),
+                test_df['video_folder_path'].to_numpy(dtype=str), test_df['label_id'].to_numpy(dtype=np.int64))
+
+    def get_loader_config(self, split):
+        """
+        Loader configuration of split (train, val, test): with autotune, probed on the dataset of that split
+        (its clips and transforms set the cost), else num_workers with the defaults
+        """
+        if not self.autotune:
+            return get_default_config(self.num_workers)
+
+        if split not in self._loader_configs:
+            self._loader_configs[split] = autotune_loader(getattr(self, split), self.batch_size, self.device)
+        return self._loader_configs[split]
+
+    def _get_dataloader(self, split, sampler=None):
+
+        loader_config = self.get_loader_config(split)
+        loader_kwargs = get_loader_kwargs(loader_config)
+
+        # Autotuned train / val loaders are iterated every epoch: their workers stay alive in between
+        if loader_config['num_workers'] > 0:
+            loader_kwargs['persistent_workers'] = self.autotune and split in ('train', 'val')
+
+        if self.ring_collate:
+            ring_size = get_ring_size(loader_config['num_workers'], loader_config['prefetch_factor'],
+                                      self.prefetch_batches)
+            loader_kwargs['collate_fn'] = ClipCollator(ring_size, loader_config['pin_memory'])
+
+        return DataLoader(getattr(self, split), batch_size=self.batch_size, sampler=sampler, **loader_kwargs)
 
     def get_train_dataloader(self):
-        return DataLoader(self.train, batch_size=self.batch_size, num_workers=self.num_workers, shuffle=True)
+        # Seeded, resumable shuffling (see train.py --resume)
+        return self._get_dataloader('train', sampler=ResumableRandomSampler(len(self.train)))
 
     def get_val_dataloader(self):
-        return DataLoader(self.val, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._get_dataloader('val')
 
     def get_test_dataloader(self):
-        return DataLoader(self.test, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._get_dataloader('test')
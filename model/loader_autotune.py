@@ -0,0 +1,209 @@
+#
+# DataLoader autotuning: probe num_workers, OpenCV / torch threads per worker, prefetch_factor
+# and pin_memory on the current machine, keep the configuration with the most clips per second
+# and save it so the next runs with the same setup skip the probe.
+#
+
+import os
+import json
+import time
+import random
+import platform
+import functools
+import contextlib
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+TUNE_FILE = './data/loader_autotune.json'
+
+PROBE_BATCHES = 8   # timed batches per configuration, after one warm-up batch
+
+
+def set_worker_threads(cv2_threads, torch_threads, worker_id):
+    """
+    worker_init_fn: every worker runs cv2 and torch with a few threads only,
+    so num_workers x threads stays within the available cores
+    """
+    cv2.setNumThreads(cv2_threads)
+    torch.set_num_threads(torch_threads)
+
+
+def get_default_config(num_workers):
+    """
+    The configuration used without autotuning, one OpenCV thread per worker
+    """
+    return {'num_workers': num_workers,
+            'cv2_threads': 1,
+            'torch_threads': 1,
+            'prefetch_factor': 2,
+            'pin_memory': False,
+            'persistent_workers': False}
+
+
+def get_loader_kwargs(config):
+    """
+    DataLoader keyword arguments of a configuration
+    """
+    kwargs = {'num_workers': config['num_workers'], 'pin_memory': config['pin_memory']}
+
+    if config['num_workers'] > 0:
+        kwargs['prefetch_factor'] = config['prefetch_factor']
+        kwargs['persistent_workers'] = config['persistent_workers']
+        kwargs['worker_init_fn'] = functools.partial(set_worker_threads, config['cv2_threads'], config['torch_threads'])
+
+    return kwargs
+
+
+def get_num_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_worker_candidates(n_cores):
+    """
+    (num_workers, cv2_threads, torch_threads) with num_workers x threads <= n_cores
+    """
+    candidates = []
+
+    for num_workers in sorted({1, 2, 4, 8, 16, 32, n_cores}):
+        if num_workers > n_cores:
+            continue
+
+        threads = n_cores // num_workers
+        candidates.append((num_workers, 1, 1))
+        if threads > 1:
+            candidates.append((num_workers, threads, 1))
+            candidates.append((num_workers, 1, threads))
+
+    return candidates
+
+
+def probe(dataset, batch_size, config, device, n_batches=PROBE_BATCHES):
+    """
+    Clips per second of a configuration, worker start-up and the first batch excluded
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, generator=torch.Generator(), **get_loader_kwargs(config))
+
+    n_clips = 0
+    iterator = iter(loader)
+
+    next(iterator)   # warm-up: workers started, first batch decoded
+
+    start = time.perf_counter()
+    for step, (image, _) in enumerate(iterator):
+        image.to(device, non_blocking=config['pin_memory'])
+        n_clips += len(image)
+        if step + 1 == n_batches:
+            break
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    del iterator   # shuts the workers down
+
+    return n_clips / (time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def detached_caches(dataset):
+    """
+    dataset without its disk (--cache_dir) and shared memory (--cache_gb) clip caches: every probe decodes,
+    instead of the later configurations reading what the first ones cached
+    """
+    caches = dataset.frame_cache, dataset.clip_cache
+    dataset.frame_cache, dataset.clip_cache = None, None
+    try:
+        yield
+    finally:
+        dataset.frame_cache, dataset.clip_cache = caches
+
+
+def get_cache_state(dataset):
+    caches = [name for name, cache in [('disk', dataset.frame_cache), ('memory', dataset.clip_cache)] if cache is not None]
+    return f"caches={'+'.join(caches) or 'none'}"
+
+
+def get_tune_key(dataset, batch_size, device):
+    """
+    What the best configuration depends on: machine, data, transforms, clip caches and batch size
+    """
+    return ' | '.join([platform.node(),
+                       f'{get_num_cores()} cores',
+                       torch.cuda.get_device_name(device) if device.type == 'cuda' else device.type,
+                       type(dataset).__name__,
+                       os.path.abspath(dataset.data_dir),
+                       repr(dataset.transform),
+                       get_cache_state(dataset),
+                       f'batch_size={batch_size}'])
+
+
+def autotune_loader(dataset, batch_size, device, tune_file=TUNE_FILE, n_batches=PROBE_BATCHES):
+    """Configuration with the highest clips / s on a fixed subset of dataset, loaded from tune_file if already probed
+
+    Coordinate search: workers and threads first, then prefetch_factor, then pin_memory (GPU only).
+    The clip caches are detached and the subset is read once beforehand (file system cache), so every
+    configuration does the same work. The random states are restored afterwards, so autotuning does not
+    change the rest of the run.
+    """
+    key = get_tune_key(dataset, batch_size, device)
+
+    results = {}
+    if os.path.exists(tune_file):
+        with open(tune_file) as f:
+            results = json.load(f)
+
+    if key in results:
+        print(f"Loader configuration from {tune_file}: {results[key]['config']}")
+        return results[key]['config']
+
+    rng_states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+
+    # Same clips for every configuration
+    n_clips = min(len(dataset), batch_size * (n_batches + 1))
+    subset = Subset(dataset, np.random.default_rng(0).permutation(len(dataset))[:n_clips].tolist())
+
+    def _probe(config):
+        speed = probe(subset, batch_size, config, device, n_batches)
+        print(f"  {config}: {speed:.1f} clips/s")
+        return speed
+
+    print(f"Autotuning the data loader ({get_num_cores()} cores)...")
+
+    best_config, best_speed = None, -1.0
+
+    with detached_caches(dataset):
+
+        # Untimed pass: the files of the subset are in the page cache for the first configuration too
+        probe(subset, batch_size, get_default_config(0), torch.device('cpu'), n_batches)
+
+        for num_workers, cv2_threads, torch_threads in get_worker_candidates(get_num_cores()):
+            config = dict(get_default_config(num_workers), cv2_threads=cv2_threads, torch_threads=torch_threads)
+            speed = _probe(config)
+            if speed > best_speed:
+                best_config, best_speed = config, speed
+
+        for name, value in [('prefetch_factor', 4)] + ([('pin_memory', True)] if device.type == 'cuda' else []):
+            config = dict(best_config, **{name: value})
+            speed = _probe(config)
+            if speed > best_speed:
+                best_config, best_speed = config, speed
+
+    random.setstate(rng_states[0])
+    np.random.set_state(rng_states[1])
+    torch.set_rng_state(rng_states[2])
+
+    print(f"Best loader configuration: {best_config} ({best_speed:.1f} clips/s)")
+
+    results[key] = {'config': best_config, 'clips_per_second': best_speed}
+
+    tune_dir = os.path.dirname(tune_file)
+    if tune_dir and not os.path.exists(tune_dir):
+        os.makedirs(tune_dir)
+    with open(tune_file, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    return best_config
@@ -0,0 +1,188 @@
+#
+# Clip manifest: label, split membership and frame files of every clip in compact NumPy arrays.
+# Built once (build_dataset.py --manifest) and saved next to the annotation CSVs, so the
+# datasets neither rebuild pandas frames nor list the clip folders at every epoch.
+#
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .clip_store import clip_sort_key
+
+
+SPLITS = ['split1', 'split2', 'split3']
+SPLIT_CODES = {'train': 0, 'test': 1}
+UNUSED = 2   # videos in no train / test set of a split (HMDB51)
+
+
+def get_manifest_path(dataset, data_dir):
+    """
+    ./data/<DATASET>/annotation/manifest_<frame folder name>.npz
+    """
+    layout = os.path.basename(os.path.normpath(data_dir))
+    return os.path.join(f'./data/{dataset.upper()}/annotation', f'manifest_{layout}.npz')
+
+
+def get_folder_stamp(data_dir):
+    """
+    (number of video folders, latest mtime of data_dir and its class folders), it changes when videos
+    are added, removed or extracted again (moved into place), for two levels of listing only
+    """
+    class_dirs = [entry for entry in os.scandir(data_dir) if entry.is_dir()]
+
+    n_videos = sum(len(os.listdir(entry.path)) for entry in class_dirs)
+    mtime_ns = max([os.stat(data_dir).st_mtime_ns] + [entry.stat().st_mtime_ns for entry in class_dirs])
+
+    return np.array([n_videos, mtime_ns], dtype=np.int64)
+
+
+class ClipManifest():
+    """
+    Videos (annotation rows) -> clips (frame folders, clip_1 .. for the multi-clip layouts) -> frame files,
+    stored as flat arrays plus offsets.
+    """
+    def __init__(self, video_paths, labels, splits, clip_paths, clip_offsets, frame_names, frame_offsets,
+                 folder_stamp=None):
+
+        self.video_paths = video_paths        # (N,) str
+        self.labels = labels                  # (N,) int64
+        self.splits = splits                  # (N, 3) uint8, SPLIT_CODES or UNUSED
+        self.clip_paths = clip_paths          # (M,) str, clips of video i: clip_offsets[i]:clip_offsets[i + 1]
+        self.clip_offsets = clip_offsets      # (N + 1,) int64
+        self.frame_names = frame_names        # (F,) str, frames of clip j: frame_offsets[j]:frame_offsets[j + 1]
+        self.frame_offsets = frame_offsets    # (M + 1,) int64
+        self.folder_stamp = folder_stamp      # (2,) int64, get_folder_stamp of data_dir when built (None: unknown)
+
+        self._video_ids = None
+        self._clip_ids = None
+
+    @classmethod
+    def build(cls, annotation_csv, data_dir):
+        """
+        List every frame folder of data_dir once, videos missing in data_dir are left out
+        """
+        df = pd.read_csv(annotation_csv)
+
+        # Before the listing: a folder changed meanwhile makes the manifest stale
+        folder_stamp = get_folder_stamp(data_dir)
+
+        video_paths, labels, splits = [], [], []
+        clip_paths, clip_offsets = [], [0]
+        frame_names, frame_offsets = [], [0]
+
+        for _, row in df.iterrows():
+
+            video_path = os.path.join(data_dir, row['video_folder_path'])
+            if not os.path.isdir(video_path):
+                continue
+
+            # 5_clips_16_frames: one sub folder per clip (clip_1, clip_2, ..)
+            sub_folders = sorted((name for name in os.listdir(video_path)
+                                  if os.path.isdir(os.path.join(video_path, name))), key=clip_sort_key)
+            clips = [os.path.join(row['video_folder_path'], name) for name in sub_folders] or [row['video_folder_path']]
+
+            for clip_path in clips:
+                frame_names.extend(sorted(os.listdir(os.path.join(data_dir, clip_path))))
+                frame_offsets.append(len(frame_names))
+                clip_paths.append(clip_path)
+
+            clip_offsets.append(len(clip_paths))
+            video_paths.append(row['video_folder_path'])
+            labels.append(row['label_id'])
+            splits.append([SPLIT_CODES.get(row[split], UNUSED) for split in SPLITS])
+
+        return cls(np.array(video_paths, dtype=str),
+                   np.array(labels, dtype=np.int64),
+                   np.array(splits, dtype=np.uint8).reshape(-1, len(SPLITS)),
+                   np.array(clip_paths, dtype=str),
+                   np.array(clip_offsets, dtype=np.int64),
+                   np.array(frame_names, dtype=str),
+                   np.array(frame_offsets, dtype=np.int64),
+                   folder_stamp)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as manifest:
+            return cls(**{key: manifest[key] for key in manifest.files})
+
+    def save(self, path):
+        stamp = {'folder_stamp': self.folder_stamp} if self.folder_stamp is not None else {}
+        np.savez(path,
+                 video_paths=self.video_paths,
+                 labels=self.labels,
+                 splits=self.splits,
+                 clip_paths=self.clip_paths,
+                 clip_offsets=self.clip_offsets,
+                 frame_names=self.frame_names,
+                 frame_offsets=self.frame_offsets,
+                 **stamp)
+
+    def is_stale(self, data_dir):
+        """
+        True if the frame folder changed since the manifest was built (or it was built without a stamp)
+        """
+        return self.folder_stamp is None or not np.array_equal(self.folder_stamp, get_folder_stamp(data_dir))
+
+    def __len__(self):
+        return len(self.video_paths)
+
+    def __getstate__(self):
+        # The lookup dicts are rebuilt lazily in each worker
+        state = self.__dict__.copy()
+        state['_video_ids'] = None
+        state['_clip_ids'] = None
+        return state
+
+    def get_split(self, split, stage):
+        """
+        Indices of the videos in the train or test set of split (split1, split2, split3)
+        """
+        return np.flatnonzero(self.splits[:, SPLITS.index(split)] == SPLIT_CODES[stage])
+
+    @property
+    def clip_numbers(self):
+        """
+        k of the clip folders clip_k, 0 for the clips that are a whole video folder
+        """
+        names = np.char.rpartition(self.clip_paths, '/')[:, 2]
+        suffixes = np.char.replace(names, 'clip_', '', count=1)
+
+        is_clip = np.char.startswith(names, 'clip_') & np.char.isdigit(suffixes)
+        return np.where(is_clip, suffixes, '0').astype(np.int64)
+
+    def get_clips(self, video_ids, clip_per_video):
+        """
+        Clip paths and labels of clip_1 .. clip_<clip_per_video> of video_ids, in that order
+        (the clips _get_annotation_pandas lists)
+        """
+        video_ids = np.asarray(video_ids, dtype=np.int64)
+
+        counts = self.clip_offsets[video_ids + 1] - self.clip_offsets[video_ids]
+        clip_ids = np.concatenate([np.arange(self.clip_offsets[i], self.clip_offsets[i + 1]) for i in video_ids] +
+                                  [np.zeros(0, dtype=np.int64)])
+        video_rows = np.repeat(np.arange(len(video_ids)), counts)
+
+        numbers = self.clip_numbers[clip_ids]
+        keep = (numbers >= 1) & (numbers <= clip_per_video)
+        clip_ids, video_rows, numbers = clip_ids[keep], video_rows[keep], numbers[keep]
+
+        order = np.lexsort((numbers, video_rows))
+        return self.clip_paths[clip_ids[order]], self.labels[video_ids[video_rows[order]]]
+
+    def clips_of(self, video_path):
+
+        if self._video_ids is None:
+            self._video_ids = {path: i for i, path in enumerate(self.video_paths)}
+
+        i = self._video_ids[video_path]
+        return self.clip_paths[self.clip_offsets[i]:self.clip_offsets[i + 1]]
+
+    def frames_of(self, clip_path):
+
+        if self._clip_ids is None:
+            self._clip_ids = {path: i for i, path in enumerate(self.clip_paths)}
+
+        i = self._clip_ids[clip_path]
+        return self.frame_names[self.frame_offsets[i]:self.frame_offsets[i + 1]]
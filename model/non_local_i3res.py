@@ -1,13 +1,10 @@
 #
 # API for non local i3res model
 #
-import os
-
-import torch
 from torch import nn
 
 from .utils import non_local_i3res_model
-from .utils.utils import download_weights
+from .weight_store import WeightStore
 
 
 class NonLocalI3Res(non_local_i3res_model.I3Res50):
@@ -28,17 +25,11 @@ class NonLocalI3Res(non_local_i3res_model.I3Res50):
         super().__init__(block=block, layers=layers, use_nl=use_nl)
 
         if use_nl:
-            file_name = "i3res_nonlocal.pth"
+            weight_name = "i3res_nonlocal"
         else:
-            file_name = "i3res_baseline.pth"
-
-        weight_path = os.path.join(weight_folder, file_name)
-
-        if not os.path.exists(weight_path):
-            print("Download non-local pretrained weights ...")
-            download_weights(weight_folder, file_name)
+            weight_name = "i3res_baseline"
 
-        self.load_state_dict(torch.load(weight_path))
+        self.load_state_dict(WeightStore(weight_folder).load(weight_name))
         print("Load pretrained weights successfully..")
 
         input_fc = self.fc.in_features
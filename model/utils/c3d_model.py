@@ -4,8 +4,12 @@
 #
 #
 
+import functools
+
 import torch.nn as nn
 
+from .utils import run_stage
+
 
 class C3D(nn.Module):
     """
@@ -41,27 +45,23 @@ class C3D(nn.Module):
 
         self.relu = nn.ReLU()
 
-    def forward(self, x):
-
-        x = x.transpose(1, 2)
-
-        h = self.relu(self.conv1(x))
-        h = self.pool1(h)
+        self.activation_checkpointing = 'none'   # or 'stage' / 'block', see utils.run_stage
 
-        h = self.relu(self.conv2(h))
-        h = self.pool2(h)
+    def _conv_relu(self, conv, h):
+        return self.relu(conv(h))
 
-        h = self.relu(self.conv3a(h))
-        h = self.relu(self.conv3b(h))
-        h = self.pool3(h)
+    def forward(self, x):
 
-        h = self.relu(self.conv4a(h))
-        h = self.relu(self.conv4b(h))
-        h = self.pool4(h)
+        h = x.transpose(1, 2)
 
-        h = self.relu(self.conv5a(h))
-        h = self.relu(self.conv5b(h))
-        h = self.pool5(h)
+        # Stages: conv + relu blocks, then pooling
+        for convs, pool in [([self.conv1], self.pool1),
+                            ([self.conv2], self.pool2),
+                            ([self.conv3a, self.conv3b], self.pool3),
+                            ([self.conv4a, self.conv4b], self.pool4),
+                            ([self.conv5a, self.conv5b], self.pool5)]:
+            blocks = [functools.partial(self._conv_relu, conv) for conv in convs] + [pool]
+            h = run_stage(blocks, h, self.activation_checkpointing)
 
         h = h.view(-1, 8192)
         h = self.relu(self.fc6(h))
@@ -5,19 +5,9 @@
 #
 
 import torch.nn as nn
-from torch.hub import load_state_dict_from_url
 
-model_urls = {
-    'resnet18': 'https://download.pytorch.org/models/resnet18-5c106cde.pth',
-    'resnet34': 'https://download.pytorch.org/models/resnet34-333f7ec4.pth',
-    'resnet50': 'https://download.pytorch.org/models/resnet50-19c8e357.pth',
-    'resnet101': 'https://download.pytorch.org/models/resnet101-5d3b4d8f.pth',
-    'resnet152': 'https://download.pytorch.org/models/resnet152-b121ed2d.pth',
-    'resnext50_32x4d': 'https://download.pytorch.org/models/resnext50_32x4d-7cdf4587.pth',
-    'resnext101_32x8d': 'https://download.pytorch.org/models/resnext101_32x8d-8ba56ff5.pth',
-    'wide_resnet50_2': 'https://download.pytorch.org/models/wide_resnet50_2-95faca4d.pth',
-    'wide_resnet101_2': 'https://download.pytorch.org/models/wide_resnet101_2-32ee1156.pth',
-}
+from .utils import run_stage
+from ..weight_store import WeightStore
 
 
 def conv3x3x3(in_planes, out_planes, stride=1, groups=1, dilation=1):
@@ -129,6 +119,7 @@ class ResNet3d(nn.Module):
         self._norm_layer = norm_layer
 
         self.modality = modality
+        self.activation_checkpointing = 'none'   # or 'stage' / 'block', see utils.run_stage
         self.inplanes = 64
         self.dilation = 1
         if replace_stride_with_dilation is None:
@@ -214,10 +205,8 @@ class ResNet3d(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            x = run_stage(layer, x, self.activation_checkpointing)
 
         return x
 
@@ -312,7 +301,7 @@ def resnet3d(arch, progress=True, modality='RGB', pretrained2d=True, **kwargs):
     Args:
         arch (str): The architecture of resnet
         modality (str): The modality of input, 'RGB' or 'Flow'
-        progress (bool): If True, displays a progress bar of the download to stderr
+        progress (bool): Unused, the 2d weights come from the local weight store (model/weight_store.py)
         pretrained2d (bool): If True, utilize the pretrained parameters in 2d models
     """
 
@@ -324,8 +313,25 @@ def resnet3d(arch, progress=True, modality='RGB', pretrained2d=True, **kwargs):
         'resnet152': (Bottleneck3d, (3, 8, 36, 3))
     }
 
-    model = ResNet3d(*arch_settings[arch], modality=modality, **kwargs)
-    if pretrained2d:
-        state_dict = load_state_dict_from_url(model_urls[arch], progress=progress)
-        model.inflate_weights(state_dict)
+    def build_model():
+        return ResNet3d(*arch_settings[arch], modality=modality, **kwargs)
+
+    if not pretrained2d:
+        return build_model()
+
+    store = WeightStore()
+    name_2d = f'{arch}_2d'
+    store.path(name_2d)
+
+    # The inflated weights are stored too, keyed by the 2d weights and the model settings,
+    # so the inflation loop only runs the first time
+    name_3d = f'i3d_{arch}_{modality}_inflated'
+    source = f'{name_2d} {store.get_hash(name_2d)} {sorted(kwargs.items())}'
+
+    if store.get_source(name_3d) == source:
+        return store.build(name_3d, build_model)
+
+    model = build_model()
+    model.inflate_weights(store.load(name_2d))
+    store.add_state_dict(name_3d, model.state_dict(), source)
     return model
@@ -8,6 +8,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision import models
 
+from ..weight_store import WeightStore
+
 
 class LateFusion(nn.Module):
     """
@@ -22,9 +24,15 @@ class LateFusion(nn.Module):
 
     def forward(self, x):
 
-        batch_size, timesteps, channel_x, h_x, w_x = x.shape
-        conv_input = x.view(batch_size * timesteps, channel_x, h_x, w_x)
-        conv_output = F.relu(self.conv_model(conv_input))
+        if x.dim() == 3:
+            # Precomputed trunk features (batch_size, timesteps, 2048), see extract_features.py
+            batch_size, timesteps, feature_dim = x.shape
+            conv_output = F.relu(self.conv_model.forward_features(x.reshape(batch_size * timesteps, feature_dim)))
+        else:
+            batch_size, timesteps, channel_x, h_x, w_x = x.shape
+            conv_input = x.view(batch_size * timesteps, channel_x, h_x, w_x)
+            conv_output = F.relu(self.conv_model(conv_input))
+
         pool_input = conv_output.view(batch_size, timesteps, -1).permute(0, 2, 1)
         pool_out = self.pooling_layer(pool_input).squeeze()
         output = self.output_layer(pool_out)
@@ -36,8 +44,8 @@ class PretrainedConv(nn.Module):
 
     def __init__(self, latent_dim):
         super(PretrainedConv, self).__init__()
-        self.conv_model = models.resnet152(pretrained=True)
-        # self.conv_model = models.resnet152(weights='DEFAULT')
+        # ImageNet weights from the local weight store, no download
+        self.conv_model = WeightStore().build('resnet152', models.resnet152)
 
         for param in self.conv_model.parameters():
             param.requires_grad = False
@@ -46,3 +54,18 @@ class PretrainedConv(nn.Module):
 
     def forward(self, x):
         return self.conv_model(x)
+
+    def train(self, mode=True):
+        # The frozen trunk keeps its ImageNet batch norm statistics in training too,
+        # so its features are the same as the ones of extract_features.py
+        super().train(mode)
+        for module in self.conv_model.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.eval()
+        return self
+
+    def forward_features(self, x):
+        """
+        Only the trainable fc on pooled (frozen) ResNet152 features
+        """
+        return self.conv_model.fc(x)
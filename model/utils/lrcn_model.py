@@ -7,6 +7,8 @@
 import torch.nn as nn
 from torchvision import models
 
+from ..weight_store import WeightStore
+
 
 class ConvLSTM(nn.Module):
     """
@@ -25,11 +27,18 @@ class ConvLSTM(nn.Module):
 
     def forward(self, x):
 
-        batch_size, timesteps, channel_x, h_x, w_x = x.shape
+        if x.dim() == 3:
+            # Precomputed trunk features (batch_size, timesteps, 2048), see extract_features.py
+            batch_size, timesteps, feature_dim = x.shape
+
+            conv_output = self.conv_model.forward_features(x.reshape(batch_size*timesteps, feature_dim))
 
-        conv_input = x.view(batch_size*timesteps, channel_x, h_x, w_x)
+        else:
+            batch_size, timesteps, channel_x, h_x, w_x = x.shape
 
-        conv_output = self.conv_model(conv_input)
+            conv_input = x.view(batch_size*timesteps, channel_x, h_x, w_x)
+
+            conv_output = self.conv_model(conv_input)
 
         lstm_input = conv_output.view(batch_size, timesteps, -1)
 
@@ -45,8 +54,8 @@ class Pretrained_conv(nn.Module):
 
     def __init__(self, latent_dim):
         super(Pretrained_conv, self).__init__()
-        self.conv_model = models.resnet152(pretrained=True)
-        # self.conv_model = models.resnet152(weights='DEFAULT')
+        # ImageNet weights from the local weight store, no download
+        self.conv_model = WeightStore().build('resnet152', models.resnet152)
 
         for param in self.conv_model.parameters():
             param.requires_grad = False
@@ -56,6 +65,21 @@ class Pretrained_conv(nn.Module):
     def forward(self, x):
         return self.conv_model(x)
 
+    def train(self, mode=True):
+        # The frozen trunk keeps its ImageNet batch norm statistics in training too,
+        # so its features are the same as the ones of extract_features.py
+        super().train(mode)
+        for module in self.conv_model.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.eval()
+        return self
+
+    def forward_features(self, x):
+        """
+        Only the trainable fc on pooled (frozen) ResNet152 features
+        """
+        return self.conv_model.fc(x)
+
 class Lstm(nn.Module):
 
     def __init__(self, latent_dim, hidden_size, lstm_layers, bidirectional):
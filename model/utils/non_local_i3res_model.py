@@ -7,6 +7,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from .utils import run_stage
 
 
 class Bottleneck(nn.Module):
@@ -53,7 +56,31 @@ class Bottleneck(nn.Module):
         return out
 
 
+def chunked_attention(query, key, value, chunk_size):
+    """
+    softmax(query key^T / sqrt(dim)) value, chunk_size queries at a time: the (chunk_size, keys) affinities
+    of a chunk are recomputed in the backward pass instead of keeping the full matrix
+    """
+    def attend(query_chunk):
+        affinity = torch.bmm(query_chunk, key.transpose(1, 2)) * (query.shape[-1]**-.5)
+        return torch.bmm(F.softmax(affinity, dim=-1), value)
+
+    outputs = []
+    for query_chunk in query.split(chunk_size, dim=1):
+        if torch.is_grad_enabled():
+            outputs.append(checkpoint(attend, query_chunk, use_reentrant=False))
+        else:
+            outputs.append(attend(query_chunk))
+
+    return torch.cat(outputs, dim=1)
+
+
 class NonLocalBlock(nn.Module):
+    # 'sdpa': fused scaled dot product attention (torch >= 2.0), 'chunked': queries by chunks,
+    # 'dense': the full (T*H*W, T*H*W / 4) affinity matrix of the original implementation
+    attention = 'sdpa' if hasattr(F, 'scaled_dot_product_attention') else 'chunked'
+    chunk_size = 1024
+
     def __init__(self, dim_in, dim_out, dim_inner):
         super(NonLocalBlock, self).__init__()
 
@@ -81,12 +108,23 @@ class NonLocalBlock(nn.Module):
         theta_shape_5d = theta.shape
         theta, phi, g = theta.view(batch_size, self.dim_inner, -1), phi.view(batch_size, self.dim_inner, -1), g.view(batch_size, self.dim_inner, -1)
 
-        theta_phi = torch.bmm(theta.transpose(1, 2), phi)  # (8, 1024, 784) * (8, 1024, 784) => (8, 784, 784)
-        theta_phi_sc = theta_phi * (self.dim_inner**-.5)
-        p = F.softmax(theta_phi_sc, dim=-1)
+        if self.attention == 'dense':
+            theta_phi = torch.bmm(theta.transpose(1, 2), phi)  # (8, 1024, 784) * (8, 1024, 784) => (8, 784, 784)
+            theta_phi_sc = theta_phi * (self.dim_inner**-.5)
+            p = F.softmax(theta_phi_sc, dim=-1)
+
+            t = torch.bmm(g, p.transpose(1, 2))
+        else:
+            # Same as dense with queries theta, keys phi and values g (the default scale is dim_inner**-.5),
+            # without materializing the affinity matrix
+            query, key, value = theta.transpose(1, 2), phi.transpose(1, 2), g.transpose(1, 2)
+            if self.attention == 'sdpa':
+                t = F.scaled_dot_product_attention(query, key, value)
+            else:
+                t = chunked_attention(query, key, value, self.chunk_size)
+            t = t.transpose(1, 2)
 
-        t = torch.bmm(g, p.transpose(1, 2))
-        t = t.view(theta_shape_5d)
+        t = t.reshape(theta_shape_5d)
 
         out = self.out(t)
         out = self.bn(out)
@@ -99,6 +137,7 @@ class I3Res50(nn.Module):
     def __init__(self, block=Bottleneck, layers=[3, 4, 6, 3], num_classes=400, use_nl=False):
         self.inplanes = 64
         super(I3Res50, self).__init__()
+        self.activation_checkpointing = 'none'   # or 'stage' / 'block', see utils.run_stage
         self.conv1 = nn.Conv3d(3, 64, kernel_size=(5, 7, 7), stride=(2, 2, 2), padding=(2, 3, 3), bias=False)
         self.bn1 = nn.BatchNorm3d(64)
         self.relu = nn.ReLU(inplace=True)
@@ -145,11 +184,11 @@ class I3Res50(nn.Module):
         x = self.relu(x)
         x = self.maxpool1(x)
 
-        x = self.layer1(x)
+        x = run_stage(self.layer1, x, self.activation_checkpointing)
         x = self.maxpool2(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = run_stage(self.layer2, x, self.activation_checkpointing)
+        x = run_stage(self.layer3, x, self.activation_checkpointing)
+        x = run_stage(self.layer4, x, self.activation_checkpointing)
 
         x = self.avgpool(x)
         x = self.drop(x)
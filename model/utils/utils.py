@@ -3,6 +3,21 @@
 # Utils file for models
 #
 #
+import inspect
+import functools
+import contextlib
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+ACTIVATION_CHECKPOINTING = ['none', 'stage', 'block']
+
+# torch >= 2.1: a different context for the recomputation
+_HAS_CONTEXT_FN = 'context_fn' in inspect.signature(checkpoint).parameters
+
+
 def download_weights(weight_folder, weight_file):
     try:
         import wandb
@@ -15,3 +30,76 @@ def download_weights(weight_folder, weight_file):
     artifact = api.artifact('dandl/dl_action_recognition/weights_collection:v0', type='weights')
 
     artifact.get_path(weight_file).download(weight_folder)
+
+
+@contextlib.contextmanager
+def frozen_bn_stats(blocks):
+    """
+    Batch norm layers of blocks leave their running statistics untouched (momentum 0, same batch count),
+    so the recomputation of a checkpointed forward does not count the same batch twice
+    """
+    bns = [m for block in blocks if isinstance(block, nn.Module)
+           for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    states = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+
+    for bn in bns:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(bns, states):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _run_blocks(blocks, x):
+    for block in blocks:
+        x = block(x)
+    return x
+
+
+def _checkpoint(function, blocks, x):
+    if _HAS_CONTEXT_FN:
+        return checkpoint(function, x, use_reentrant=False,
+                          context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(blocks)))
+
+    # Older torch: the first call is the forward, the later ones recompute it
+    calls = []
+
+    def _run(x):
+        with frozen_bn_stats(blocks) if calls else contextlib.nullcontext():
+            calls.append(None)
+            return function(x)
+
+    return checkpoint(_run, x, use_reentrant=False)
+
+
+def run_stage(blocks, x, mode='none'):
+    """
+    x through blocks (the blocks of one stage, in order) with activation checkpointing:
+    'stage' only keeps the input of the stage for the backward pass, 'block' the input of every block,
+    the other activations are recomputed during the backward pass. 'none', or without grad: plain forward
+    """
+    if mode == 'none' or not torch.is_grad_enabled():
+        return _run_blocks(blocks, x)
+
+    if mode == 'stage':
+        return _checkpoint(functools.partial(_run_blocks, blocks), blocks, x)
+
+    for block in blocks:
+        x = _checkpoint(block, [block], x)
+    return x
+
+
+def set_activation_checkpointing(model, mode):
+    """
+    Activation checkpointing mode of every module of model running its stages with run_stage
+    (ResNet3d, I3Res50, C3D)
+    """
+    modules = [m for m in model.modules() if hasattr(m, 'activation_checkpointing')]
+
+    if not modules and mode != 'none':
+        raise ValueError(f"{type(model).__name__} does not support activation checkpointing")
+
+    for module in modules:
+        module.activation_checkpointing = mode
@@ -0,0 +1,138 @@
+#
+# Frame sampling and sequential decoding straight from the raw videos
+#
+
+import os
+import random
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+SAMPLE_TYPES = ['5_frames_uniform', '16_frames_conse_rand']
+
+
+def sample_frame_indices(frame_count, sample_type):
+    """
+    Frame indices of one clip, same sampling as the extracted datasets:
+    5_frames_uniform: 5 frames uniformly distributed over the video
+    16_frames_conse_rand: 16 consecutive frames from a random start
+    Indices are clamped to the last frame for videos that are too short.
+    """
+    if sample_type == '5_frames_uniform':
+        skip_interval = max(int(frame_count / 5), 1)
+        indices = [counter * skip_interval for counter in range(5)]
+
+    elif sample_type == '16_frames_conse_rand':
+        start_point = random.randint(0, frame_count - 16 - 1) if frame_count > 16 else 0
+        indices = [start_point + counter for counter in range(16)]
+
+    else:
+        raise ValueError(f"Not supporting this sample type: {sample_type}")
+
+    return [min(index, max(frame_count - 1, 0)) for index in indices]
+
+
+def sample_clip_indices(frame_count, clip_per_video, clip_len=16):
+    """
+    Frame indices of clip_per_video clips of clip_len consecutive frames, evenly spaced
+    over the video (the 5_clips_16_frames layout)
+    """
+    starts = np.linspace(0, max(frame_count - clip_len, 0), clip_per_video).astype(int)
+
+    return [[min(start + counter, max(frame_count - 1, 0)) for counter in range(clip_len)] for start in starts]
+
+
+class VideoReader():
+    """
+    cv2.VideoCapture that only moves forward: frames are reached with grab() and only the
+    wanted ones are decoded with retrieve(), instead of one seek per frame.
+    """
+    def __init__(self, video_path):
+
+        self.video_path = video_path
+        self.capture = cv2.VideoCapture(video_path)
+
+        if not self.capture.isOpened():
+            raise FileNotFoundError(f"Can not open the video {video_path}")
+
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.position = 0    # index of the next frame grab() returns
+
+    def _rewind(self):
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.position = 0
+
+    def read(self, frame_indices):
+        """
+        RGB frames (uint8) at frame_indices, in the given order.
+        Frames after the real end of the video are replaced by the last decoded one.
+        """
+        wanted = sorted(set(frame_indices))
+
+        if wanted and wanted[0] < self.position:
+            self._rewind()
+
+        decoded = {}
+        last_frame = None
+
+        for index in wanted:
+
+            while self.position < index and self.capture.grab():
+                self.position += 1
+
+            ok = self.position == index and self.capture.grab()
+            if ok:
+                ok, frame = self.capture.retrieve()
+            if not ok:
+                break
+
+            self.position += 1
+            last_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            decoded[index] = last_frame
+
+        if last_frame is None:
+            raise RuntimeError(f"Can not decode any frame of {self.video_path}")
+
+        return [decoded.get(index, last_frame) for index in frame_indices]
+
+    def release(self):
+        self.capture.release()
+
+
+class VideoReaderPool():
+    """
+    Small LRU pool of open VideoReader, one pool per DataLoader worker process
+    """
+    def __init__(self, max_open=4):
+
+        self.max_open = max_open
+        self._readers = OrderedDict()
+        self._pid = os.getpid()
+
+    def get(self, video_path):
+
+        # Handles opened before the fork belong to the parent process
+        if os.getpid() != self._pid:
+            self._readers = OrderedDict()
+            self._pid = os.getpid()
+
+        if video_path in self._readers:
+            self._readers.move_to_end(video_path)
+            return self._readers[video_path]
+
+        if len(self._readers) >= self.max_open:
+            _, reader = self._readers.popitem(last=False)
+            reader.release()
+
+        reader = VideoReader(video_path)
+        self._readers[video_path] = reader
+
+        return reader
+
+    def __getstate__(self):
+        # Open captures can not be pickled (spawn start method)
+        state = self.__dict__.copy()
+        state['_readers'] = OrderedDict()
+        return state
@@ -0,0 +1,282 @@
+#
+# Pretrained weight store: every weight file is kept once in model/weights/ under its sha256,
+# index.json maps the names used by the models to the hashes. Models only load from here,
+# so building them never needs the network.
+#
+#   python -m model.weight_store import resnet152 /path/to/resnet152-394f9c45.pth
+#   python -m model.weight_store fetch c3d      # one-time download, then offline
+#   python -m model.weight_store list
+#
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import inspect
+import zipfile
+import argparse
+import contextlib
+
+import torch
+
+
+WEIGHT_DIR = './model/weights/'
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+
+# torch >= 2.1: modules can be built on the meta device and get the loaded tensors assigned
+CAN_ASSIGN = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+# torch >= 2.1: torch.load(mmap=True)
+CAN_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+# name: download url, or file of the wandb weights collection (model/utils/utils.py)
+WEIGHT_SOURCES = {
+    # torchvision ImageNet ResNet152, frozen trunk of Late Fusion / LRCN
+    'resnet152': 'https://download.pytorch.org/models/resnet152-394f9c45.pth',
+    # C3D pretrained on Sports1M
+    'c3d': 'c3d.pickle',
+    # I3Res50 pretrained on Kinetics, without / with the non-local blocks
+    'i3res_baseline': 'i3res_baseline.pth',
+    'i3res_nonlocal': 'i3res_nonlocal.pth',
+    # ImageNet 2d ResNets inflated by I3D (see i3d_resnet3d_backbones.resnet3d)
+    'resnet18_2d': 'https://download.pytorch.org/models/resnet18-5c106cde.pth',
+    'resnet34_2d': 'https://download.pytorch.org/models/resnet34-333f7ec4.pth',
+    'resnet50_2d': 'https://download.pytorch.org/models/resnet50-19c8e357.pth',
+    'resnet101_2d': 'https://download.pytorch.org/models/resnet101-5d3b4d8f.pth',
+    'resnet152_2d': 'https://download.pytorch.org/models/resnet152-b121ed2d.pth',
+    'resnext50_32x4d_2d': 'https://download.pytorch.org/models/resnext50_32x4d-7cdf4587.pth',
+    'resnext101_32x8d_2d': 'https://download.pytorch.org/models/resnext101_32x8d-8ba56ff5.pth',
+    'wide_resnet50_2_2d': 'https://download.pytorch.org/models/wide_resnet50_2-95faca4d.pth',
+    'wide_resnet101_2_2d': 'https://download.pytorch.org/models/wide_resnet101_2-32ee1156.pth',
+}
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class WeightStore():
+    """Content addressed weight files: <root>/blobs/<sha256>.pth plus <root>/index.json (name -> sha256)
+
+    Example:
+    ```
+    store = WeightStore()
+    model.load_state_dict(store.load('c3d'))
+    ```
+    """
+    def __init__(self, root=WEIGHT_DIR):
+        self.root = root
+
+    @property
+    def index_path(self):
+        return os.path.join(self.root, INDEX_FILE)
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.root, 'blobs', f'{sha256}.pth')
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Exclusive lock of the store, around every read-modify-write of the index (parallel runs)
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __contains__(self, name):
+        return name in self._read_index()
+
+    def _add_blob(self, name, tmp_path, sha256, source):
+        """
+        Move tmp_path to its blob (kept if the same content is already stored) and point name to it
+        """
+        blob_path = self._blob_path(sha256)
+
+        with self._locked():
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, blob_path)
+
+            index = self._read_index()
+            index[name] = {'sha256': sha256, 'size': os.path.getsize(blob_path), 'source': source}
+            self._write_index(index)
+
+        return blob_path
+
+    def _tmp_path(self):
+        os.makedirs(os.path.join(self.root, 'blobs'), exist_ok=True)
+        return os.path.join(self.root, 'blobs', f'.{os.getpid()}.tmp')
+
+    def add(self, name, file_path):
+        """
+        Import a local weight file under name, hard linked when possible (no second copy on disk,
+        so the file must not be overwritten in place afterwards), else copied
+        """
+        tmp_path = self._tmp_path()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        try:
+            os.link(file_path, tmp_path)
+        except OSError:
+            # Another file system, or links not supported
+            shutil.copyfile(file_path, tmp_path)
+
+        blob_path = self._add_blob(name, tmp_path, hash_file(tmp_path), os.path.abspath(file_path))
+        print(f"Imported {file_path} as {name} ({blob_path})")
+
+        return blob_path
+
+    def add_state_dict(self, name, state_dict, source):
+        """
+        Store weights computed from other stored weights (e.g. inflated), source: what they depend on
+        """
+        tmp_path = self._tmp_path()
+        torch.save(state_dict, tmp_path)
+
+        return self._add_blob(name, tmp_path, hash_file(tmp_path), source)
+
+    def get_hash(self, name):
+        entry = self._read_index().get(name)
+        return entry['sha256'] if entry is not None else None
+
+    def get_source(self, name):
+        entry = self._read_index().get(name)
+        return entry['source'] if entry is not None else None
+
+    def _find_local(self, name):
+        """
+        A file of name already on disk: the old <root>/<file> layout or the torch hub cache
+        """
+        source = WEIGHT_SOURCES.get(name)
+        if source is None:
+            return None
+
+        file_name = os.path.basename(source)
+        for file_path in [os.path.join(self.root, file_name),
+                          os.path.join(torch.hub.get_dir(), 'checkpoints', file_name)]:
+            if os.path.exists(file_path):
+                return file_path
+        return None
+
+    def path(self, name):
+        """
+        Blob of name, imported from a local copy on the first use. Never downloads
+        """
+        sha256 = self.get_hash(name)
+        if sha256 is not None and os.path.exists(self._blob_path(sha256)):
+            return self._blob_path(sha256)
+
+        file_path = self._find_local(name)
+        if file_path is not None:
+            return self.add(name, file_path)
+
+        raise FileNotFoundError(f"No '{name}' weights in {self.root}. Import a local file with "
+                                f"`python -m model.weight_store import {name} <file>` or download it once with "
+                                f"`python -m model.weight_store fetch {name}`")
+
+    def load(self, name, map_location='cpu'):
+        """
+        State dict of name, memory-mapped when the file format allows it
+        """
+        file_path = self.path(name)
+
+        # Legacy (non zip) torch.save files cannot be memory-mapped
+        if CAN_MMAP and zipfile.is_zipfile(file_path):
+            return torch.load(file_path, map_location=map_location, mmap=True)
+        return torch.load(file_path, map_location=map_location)
+
+    def build(self, name, model_fn):
+        """
+        model_fn() with the weights of name, without running its random initialization when possible
+        """
+        state_dict = self.load(name)
+
+        if CAN_ASSIGN:
+            with torch.device('meta'):
+                model = model_fn()
+            model.load_state_dict(state_dict, assign=True)
+        else:
+            model = model_fn()
+            model.load_state_dict(state_dict)
+
+        return model
+
+    def fetch(self, name):
+        """
+        Download name from its source into the store (the only step that uses the network)
+        """
+        source = WEIGHT_SOURCES[name]
+        tmp_dir = self._tmp_path() + '.d'
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        try:
+            file_path = os.path.join(tmp_dir, os.path.basename(source))
+            if source.startswith('https://'):
+                torch.hub.download_url_to_file(source, file_path)
+            else:
+                from .utils.utils import download_weights
+                download_weights(tmp_dir, source)
+            return self.add(name, file_path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def get_arg_parser():
+    """
+    Get options from CLI
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--weight_dir', type=str, default=WEIGHT_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import')   # local file
+    import_parser.add_argument('name', type=str, choices=list(WEIGHT_SOURCES))
+    import_parser.add_argument('file_path', type=str)
+
+    fetch_parser = subparsers.add_parser('fetch')   # download
+    fetch_parser.add_argument('names', type=str, nargs='+', choices=list(WEIGHT_SOURCES))
+
+    subparsers.add_parser('list')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = get_arg_parser()
+    store = WeightStore(args.weight_dir)
+
+    if args.command == 'import':
+        store.add(args.name, args.file_path)
+
+    elif args.command == 'fetch':
+        for name in args.names:
+            store.fetch(name)
+
+    else:
+        for name, entry in sorted(store._read_index().items()):
+            print(f"{name:24s} {entry['sha256'][:16]}  {entry['size'] / 2**20:8.1f}MB  {entry['source']}")
@@ -0,0 +1,55 @@
+#
+# python -m pytest tests/
+#
+import collections
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from model.data_loader import ClipCollator, get_ring_size
+
+
+class IndexClips(Dataset):
+    """
+    Clip idx is filled with idx, so a batch overwritten by a later one is easy to spot
+    """
+    def __len__(self):
+        return 64
+
+    def __getitem__(self, idx):
+        return torch.full((4, 8, 8, 3), idx, dtype=torch.int64), torch.tensor(idx)
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+@pytest.mark.parametrize('prefetch_batches', [0, 2])
+def test_ring_keeps_alive_batches(num_workers, prefetch_batches):
+
+    prefetch_factor = 2
+    ring_size = get_ring_size(num_workers, prefetch_factor, prefetch_batches)
+    loader_kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+    loader = DataLoader(IndexClips(), batch_size=4, num_workers=num_workers,
+                        collate_fn=ClipCollator(ring_size), **loader_kwargs)
+
+    batches = iter(loader)
+    staged = collections.deque()   # what a BatchPrefetcher of depth prefetch_batches holds
+    current, previous = None, None   # the batch in use, the one before (a non_blocking copy may still read it)
+    n_batches = 0
+
+    while True:
+        # Batch k + 1 (and the ones staged after it) are collated while batch k is in use
+        while len(staged) <= prefetch_batches:
+            batch = next(batches, None)
+            if batch is None:
+                break
+            staged.append((batch[0], batch[0].clone()))
+
+        for image, expected in [*staged] + [batch for batch in (current, previous) if batch is not None]:
+            assert torch.equal(image, expected)
+
+        if not staged:
+            break
+        current, previous = staged.popleft(), current
+        n_batches += 1
+
+    assert n_batches == len(loader)
@@ -0,0 +1,88 @@
+#
+# python -m pytest tests/
+#
+import copy
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from model.utils.non_local_i3res_model import I3Res50, NonLocalBlock
+from model.weight_store import WeightStore
+
+
+# Parameters and buffers of a block in the original implementation (i3res_nonlocal.pth)
+NON_LOCAL_STATE = {'theta.weight': (32, 64, 1, 1, 1), 'theta.bias': (32,),
+                   'phi.weight': (32, 64, 1, 1, 1), 'phi.bias': (32,),
+                   'g.weight': (32, 64, 1, 1, 1), 'g.bias': (32,),
+                   'out.weight': (64, 32, 1, 1, 1), 'out.bias': (64,),
+                   'bn.weight': (64,), 'bn.bias': (64,), 'bn.running_mean': (64,), 'bn.running_var': (64,),
+                   'bn.num_batches_tracked': ()}
+
+ATTENTIONS = [('chunked', 100),    # 4 x 14 x 14 = 784 queries: 7 chunks of 100 and one of 84
+              ('chunked', 4096),   # one chunk
+              pytest.param('sdpa', None, marks=pytest.mark.skipif(not hasattr(F, 'scaled_dot_product_attention'),
+                                                                  reason='torch < 2.0'))]
+
+
+def run_block(block, x):
+    x = x.clone().requires_grad_(True)
+    out = block(x)
+    out.backward(torch.linspace(-1, 1, out.numel(), dtype=out.dtype).view_as(out))
+    return out.detach(), x.grad, {name: p.grad for name, p in block.named_parameters()}
+
+
+@pytest.mark.parametrize('attention, chunk_size', ATTENTIONS)
+def test_attention_matches_dense(attention, chunk_size):
+
+    torch.manual_seed(0)
+    dense = NonLocalBlock(64, 64, 32).double()
+    dense.attention = 'dense'
+    # The last batch norm starts at zero in the pretrained model, random here so the attention reaches the output
+    torch.nn.init.normal_(dense.bn.weight)
+
+    block = copy.deepcopy(dense)
+    block.attention = attention
+    if chunk_size is not None:
+        block.chunk_size = chunk_size
+
+    x = torch.randn(2, 64, 4, 14, 14, dtype=torch.float64)
+    out, x_grad, grads = run_block(block, x)
+    out_ref, x_grad_ref, grads_ref = run_block(dense, x)
+
+    torch.testing.assert_close(out, out_ref, rtol=1e-8, atol=1e-8)
+    torch.testing.assert_close(x_grad, x_grad_ref, rtol=1e-8, atol=1e-8)
+    for name in grads_ref:
+        torch.testing.assert_close(grads[name], grads_ref[name], rtol=1e-8, atol=1e-8)
+
+    # Same running statistics after the step
+    torch.testing.assert_close(block.state_dict(), dense.state_dict())
+
+
+def test_block_state_dict_unchanged():
+
+    state = NonLocalBlock(64, 64, 32).state_dict()
+
+    assert {name: tuple(tensor.shape) for name, tensor in state.items()} == NON_LOCAL_STATE
+
+
+def test_pretrained_weights_load_strictly():
+
+    store = WeightStore()
+    if 'i3res_nonlocal' not in store:
+        pytest.skip("no i3res_nonlocal weights (python -m model.weight_store fetch i3res_nonlocal)")
+
+    model = I3Res50(num_classes=400, use_nl=True)
+    model.load_state_dict(store.load('i3res_nonlocal'), strict=True)
+    model.eval()
+
+    x = torch.randn(1, 8, 3, 112, 112)   # (batch, frames, channels, height, width)
+    with torch.no_grad():
+        out = model(x)
+        NonLocalBlock.attention, attention = 'dense', NonLocalBlock.attention
+        try:
+            out_ref = model(x)
+        finally:
+            NonLocalBlock.attention = attention
+
+    torch.testing.assert_close(out, out_ref, rtol=1e-4, atol=1e-5)
@@ -1,14 +1,12 @@
 #
 # main file
 #
+import math
 from tqdm import tqdm
 from torch import nn
-from model.lrcn import LRCN
-from model.c3d import C3D
-from model.i3d import I3D
-from model.non_local_i3res import NonLocalI3Res
-from model.late_fusion import LateFusion
-from model.data_loader import ActionRecognitionDataWrapper
+from model import MODEL_NAMES, add_model_args, build_model
+from model.utils.utils import ACTIVATION_CHECKPOINTING, set_activation_checkpointing
+from model.data_loader import ActionRecognitionDataWrapper, ResumableRandomSampler
 from evaluate import val_evaluate
 from utils import seed_everything, get_training_device, acc_metrics, get_lr, get_transforms
 import os
@@ -38,44 +36,41 @@ def get_arg_parser():
 
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--autotune', action='store_true')   # probe the loader settings (saved in ./data/loader_autotune.json)
+    parser.add_argument('--ring_collate', action='store_true')   # collate into reused (pinned) batch buffers
+    parser.add_argument('--decode_threads', type=int, default=0)   # threads decoding the frames of a clip in each worker
+    parser.add_argument('--prefetch_batches', type=int, default=2)   # batches staged on the device ahead, 0: no thread
     parser.add_argument('--clip_per_video', type=int, default=1)
+    parser.add_argument('--normalize_on_device', action='store_true')   # workers ship uint8 clips
+    parser.add_argument('--full_decode', action='store_true')   # no reduced scale JPEG decode
+    parser.add_argument('--cache_dir', type=str, default='')   # on-disk cache of the resized frames
+    parser.add_argument('--cache_gb', type=float, default=0)   # shared memory cache of the decoded clips
+    parser.add_argument('--augment', action='store_true')   # random crop / flip / color jitter per clip
+    parser.add_argument('--data_format', type=str, default='frames',
+                        choices=['frames', 'packed', 'features', 'video'])   # features: see extract_features.py
 
     # hyperparameters specific args
     parser.add_argument('--max_epochs', type=int, default=5)
     parser.add_argument('--lr', type=float, default=1e-4)
     parser.add_argument('--sl_gammar', type=float, default=0.999)
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=utils.PRECISIONS)   # autocast of the forward passes, bf16 also on CPU
+    parser.add_argument('--accum_steps', type=int, default=1)   # micro-batches per --batch_size batch, 0: as few as fit on the GPU
+    parser.add_argument('--activation_checkpointing', type=str, default='none',
+                        choices=ACTIVATION_CHECKPOINTING)   # recompute the activations of each stage / block (3D CNNs)
 
     # Module specific args
     # which model to use
     parser.add_argument('--model_name', type=str, required=True,
-                        choices=["lrcn", "c3d", "i3d", "non_local", "late_fusion"])
+                        choices=MODEL_NAMES)
 
     # Get the model name now
     temp_args, _ = parser.parse_known_args()
 
-    if temp_args.model_name == "late_fusion":
-        parser = LateFusion.add_model_specific_args(parser)
-        parser.add_argument('--resize_to', type=int, default=256)   # 5 uni
+    if temp_args.data_format == 'features' and temp_args.model_name not in ['late_fusion', 'lrcn']:
+        parser.error("--data_format features only supports the ResNet152 based models (late_fusion, lrcn)")
 
-    elif temp_args.model_name == "lrcn":
-        parser = LRCN.add_model_specific_args(parser)
-        # Data transform
-        parser.add_argument('--resize_to', type=int, default=256)   # 5 uni
-
-    elif temp_args.model_name == "c3d":
-        parser = C3D.add_model_specific_args(parser)
-        # Data transform
-        parser.add_argument('--resize_to', type=int, default=112)
-
-    elif temp_args.model_name == "i3d":
-        parser = I3D.add_model_specific_args(parser)
-
-        # Data transform
-        parser.add_argument('--resize_to', type=int, default=224)
-
-    elif temp_args.model_name == "non_local":
-        parser = NonLocalI3Res.add_model_specific_args(parser)
-        parser.add_argument('--resize_to', type=int, default=224)
+    parser = add_model_args(parser, temp_args.model_name)
 
     # Wandb specific args
     parser.add_argument('--enable_wandb', action='store_true')
@@ -84,70 +79,221 @@ def get_arg_parser():
     parser.add_argument('--wandb_ckpt', action='store_true')
     parser.add_argument('--save_loss_steps', type=int, default=10)
     parser.add_argument('--save_ckp_epochs', type=int, default=0)   # default is not
+    parser.add_argument('--save_ckp_steps', type=int, default=0)   # also save last.pth every n steps (0: epochs only)
+    parser.add_argument('--resume', action='store_true')   # continue from <ckp_dir>/last.pth
+    parser.add_argument('--delta_checkpoint', action='store_true')   # save the trainable weights only (frozen trunks)
 
     return parser.parse_args()
 
 
-def train(model, train_loader, criterion, optimizer, scheduler, wandb_logger, start_steps, args):
+def get_training_state(model, optimizer, scheduler, sampler, epoch, step, best_val_acc, args, delta_base=None, scaler=None,
+                       loss_avg=None):
+    """
+    Checkpoint of the training after `step` batches of `epoch` (step 0: epoch completed epochs),
+    with everything train.py --resume needs to continue from the next batch
+    delta_base: utils.DeltaCheckpoint, save the trainable parameters and changed buffers only
+    scaler: the fp16 GradScaler, its current loss scale is saved too
+    loss_avg: running train loss of the epoch so far (mid-epoch checkpoints)
+    """
+    state = {'epoch': epoch,
+             'step': step,
+             'state_dict': delta_base.state_dict(model) if delta_base else model.state_dict(),
+             'optim_dict': optimizer.state_dict(),
+             'sched_dict': scheduler.state_dict(),
+             'best_val_acc': best_val_acc}
+
+    if delta_base:
+        state['base_hash'] = delta_base.base_hash
+
+    if scaler is not None and scaler.is_enabled():
+        state['scaler_dict'] = scaler.state_dict()
+
+    if loss_avg is not None:
+        state['loss_avg'] = loss_avg.state_dict()
+
+    if isinstance(sampler, ResumableRandomSampler):
+        state['sampler'] = sampler.state_dict(step * args.batch_size)
+
+    return state
+
+
+def forward_backward(model, criterion, image, label, n_micro, autocast, scaler):
+    """
+    Gradients of the batch accumulated over n_micro micro-batches, each micro-batch loss weighted
+    by its share of the batch so the sum is the gradient of the whole batch loss
+    Returns the batch loss
+    """
+    batch_size = len(label)
+    batch_loss = 0.0
+
+    for image_micro, label_micro in zip(image.tensor_split(n_micro), label.tensor_split(n_micro)):
+        if len(label_micro) == 0:
+            continue
+
+        # forward
+        with autocast:
+            output = model(image_micro)
+        loss = criterion(output.float(), label_micro) * (len(label_micro) / batch_size)   # loss in fp32
+
+        # backward
+        scaler.scale(loss).backward()
+        batch_loss += loss.detach()
+
+    return batch_loss
+
+
+def report_activation_checkpointing(model, criterion, clip_shape, args):
+    """
+    Activation memory and time of one training step on a micro-batch of random clips, without and with
+    --activation_checkpointing. Measured in eval mode, so the batch norm statistics are not updated
+    """
+    batch_size = math.ceil(args.batch_size / max(args.accum_steps, 1))
+    image = torch.rand((batch_size,) + tuple(clip_shape), generator=torch.Generator().manual_seed(0)).to(args.device)
+    label = torch.zeros(batch_size, dtype=torch.long, device=args.device)
+
+    autocast = utils.get_autocast(args.precision, args.device)
+
+    model.eval()
+    results = {}
+    for mode in ['none', args.activation_checkpointing]:
+        set_activation_checkpointing(model, mode)
+        try:
+            utils.measure_step(model, criterion, image, label, autocast)   # warm-up
+            results[mode] = utils.measure_step(model, criterion, image, label, autocast)
+        except torch.cuda.OutOfMemoryError:
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+            results[mode] = None
+    model.train()
+
+    print(f"Activation checkpointing ({args.activation_checkpointing}), one step of {batch_size} clips:")
+    for mode, result in results.items():
+        if result is None:
+            print(f"  {mode}: out of memory")
+        else:
+            print(f"  {mode}: activations {result[0] / 2**30:.2f}GB, {result[1]:.2f}s")
+
+    if results['none'] is not None and results[args.activation_checkpointing] is not None:
+        (memory, elapsed), (memory_ckp, elapsed_ckp) = results['none'], results[args.activation_checkpointing]
+        print(f"  memory saved {1 - memory_ckp / max(memory, 1):.0%}, extra compute {elapsed_ckp / elapsed - 1:+.0%}")
+
+
+def train(model, train_loader, criterion, optimizer, scheduler, wandb_logger, start_steps, args, epoch=0, best_val_acc=0.0,
+          delta_base=None, scaler=None, loss_state=None):
     """
     One model training loop
+    loss_state: running train loss of the steps done before a mid-epoch resume
     """
     model.train()
     loss_avg = utils.RunningAverage()
+    if loss_state is not None:
+        loss_avg.load_state_dict(loss_state)
+
+    # Mixed precision: autocast forward, loss scaling for fp16 (a no-op for fp32 / bf16)
+    autocast = utils.get_autocast(args.precision, args.device)
+    if scaler is None:
+        scaler = utils.get_grad_scaler(args.precision)
+    meter = utils.ThroughputMeter(args.device)
+
+    # Each batch is split into micro-batches (one forward / backward each) and the optimizer steps once per
+    # batch: steps, logging, scheduler and checkpoints count batches of --batch_size whatever the split.
+    # --accum_steps 0: start with the whole batch and split twice as much after a CUDA out of memory
+    n_micro = args.accum_steps or 1
 
-    with tqdm(total=len(train_loader)) as t:
-        for step, data in enumerate(train_loader):
+    # Batches moved to the device and normalized on a background thread
+    batches = utils.BatchPrefetcher(train_loader, args.device, depth=args.prefetch_batches)
+
+    # Resumed in the middle of the epoch: the sampler skips the batches already seen
+    sampler = train_loader.sampler
+    first_step = sampler.start // args.batch_size if isinstance(sampler, ResumableRandomSampler) else 0
+    n_steps = first_step + len(train_loader)
+
+    with tqdm(total=n_steps, initial=first_step) as t:
+        for step, data in enumerate(batches, start=first_step):
 
             it = start_steps + step          # current global step
 
             image, label = data
-            image = image.to(args.device, non_blocking=True)
-            label = label.to(args.device, non_blocking=True)
-
-            # forward
-            output = model(image)
-            loss = criterion(output, label)
 
-            # backward
-            loss.backward()
-            optimizer.step()  # update weight
+            # forward / backward
+            while True:
+                try:
+                    loss = forward_backward(model, criterion, image, label, n_micro, autocast, scaler)
+                    break
+                except torch.cuda.OutOfMemoryError:
+                    if args.accum_steps or n_micro >= len(label):
+                        raise
+                    optimizer.zero_grad(set_to_none=True)
+                    torch.cuda.empty_cache()
+                    n_micro *= 2
+                    print(f"Out of memory: {n_micro} micro-batches of {math.ceil(len(label) / n_micro)} clips")
+
+            scaler.step(optimizer)  # update weight
+            scaler.update()
             optimizer.zero_grad()  # reset gradient
 
             loss_avg.update(loss.item())
+            meter.update(len(image))
 
             if wandb_logger and it % args.save_loss_steps == 0:
 
                 wandb_logger._wandb.log({'train/loss': loss_avg()}, commit=False)
                 wandb_logger._wandb.log({'train/lr': get_lr(optimizer)}, commit=False)
+                wandb_logger._wandb.log({'train/data_wait': batches.wait_fraction}, commit=False)
                 wandb_logger._wandb.log({'trainer/global_step': it})
 
-            t.set_postfix(loss='{:05.3f}'.format(loss_avg()))
+            t.set_postfix(loss='{:05.3f}'.format(loss_avg()), data_wait='{:.0%}'.format(batches.wait_fraction))
             t.update()
 
+            # Mid-epoch checkpoint (the end of the epoch is saved by train_and_valid)
+            if args.save_ckp_steps and (step + 1) % args.save_ckp_steps == 0 and step + 1 < n_steps:
+                utils.save_checkpoint(get_training_state(model, optimizer, scheduler, sampler, epoch, step + 1, best_val_acc, args,
+                                                         delta_base, scaler, loss_avg),
+                                      is_best=False,
+                                      checkpoint=args.ckp_dir)
+
     current_lr = get_lr(optimizer)
 
     # step scheduler
     scheduler.step()
 
+    clips_per_second, peak_memory_gb = meter.clips_per_second(), meter.peak_memory_gb()
+
+    if wandb_logger:
+        wandb_logger._wandb.log({'train/clips_per_second': clips_per_second,
+                                 'train/peak_memory_gb': peak_memory_gb},
+                                commit=False)
+
     print("Learning Rate: {}..".format(current_lr),
-          "Train Loss: {:.3f}..".format(loss_avg()))
+          "Train Loss: {:.3f}..".format(loss_avg()),
+          "Data wait: {:.0%}..".format(batches.data_wait()),
+          "Throughput ({}): {:.1f} clips/s..".format(args.precision, clips_per_second),
+          "Peak memory: {:.2f}GB..".format(peak_memory_gb))
 
 
-def train_and_valid(epochs, model, train_loader, val_loader, criterion, optimizer, scheduler, ckp_dir, wandb_logger, args):
+def train_and_valid(epochs, model, train_loader, val_loader, criterion, optimizer, scheduler, ckp_dir, wandb_logger, args,
+                    start_epoch=0, best_val_acc=0.0, delta_base=None, scaler=None, loss_state=None):
     """
     Train and valid process including many epochs
+    loss_state: running train loss of the resumed epoch (mid-epoch resume)
     """
     if wandb_logger:
         wandb_logger.log_info()  # Get wandb info
         wandb_logger.set_steps()
 
-    best_val_acc = 0.0
+    sampler = train_loader.sampler
+    steps_per_epoch = math.ceil(len(train_loader.dataset) / args.batch_size)
 
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
 
         print("Epoch {}/{}".format(epoch + 1, epochs))
 
-        train(model, train_loader, criterion, optimizer, scheduler, wandb_logger, epoch * len(train_loader), args)
+        if isinstance(sampler, ResumableRandomSampler):
+            sampler.set_epoch(epoch)
+
+        train(model, train_loader, criterion, optimizer, scheduler, wandb_logger, epoch * steps_per_epoch, args,
+              epoch=epoch, best_val_acc=best_val_acc, delta_base=delta_base, scaler=scaler,
+              loss_state=loss_state if epoch == start_epoch else None)
 
         val_loss, val_acc = val_evaluate(model, val_loader, criterion, acc_metrics, args)
 
@@ -163,18 +309,19 @@ def train_and_valid(epochs, model, train_loader, val_loader, criterion, optimize
         is_best = val_acc >= best_val_acc
         if is_best:
             print("- Found new best accuracy performance")
+            best_val_acc = val_acc
 
         # Checkpoint saving
-        utils.save_checkpoint({'epoch': epoch + 1,
-                               'state_dict': model.state_dict(),
-                               'optim_dict': optimizer.state_dict()},
+        if isinstance(sampler, ResumableRandomSampler):
+            sampler.set_epoch(epoch + 1)
+
+        utils.save_checkpoint(get_training_state(model, optimizer, scheduler, sampler, epoch + 1, 0, best_val_acc, args, delta_base,
+                                                 scaler),
                               is_best=is_best,
                               checkpoint=ckp_dir)
 
         # Save the best
         if is_best:
-            best_val_acc = val_acc
-
             b_json_path = os.path.join(ckp_dir, 'metrics_val_best_weights.json')
             utils.save_dict_to_json({'val_acc': val_acc}, b_json_path)
 
@@ -208,36 +355,24 @@ if __name__ == '__main__':
     data_wrapper = ActionRecognitionDataWrapper(**dict_args,
                                                 transforms=get_transforms(args))
 
-    # Get NUM_CLASSES
-    if args.dataset == 'hmdb51':
-        NUM_CLASSES = 51
-    else:
-        NUM_CLASSES = 101
-
     # Get model
-    if args.model_name == "late_fusion":
-        net = LateFusion(**dict_args,
-                         n_class=NUM_CLASSES)
-    elif args.model_name == "lrcn":
-        net = LRCN(**dict_args,
-                   n_class=NUM_CLASSES)
-    elif args.model_name == "c3d":
-        net = C3D(**dict_args,
-                  n_class=NUM_CLASSES)
-    elif args.model_name == "i3d":
-        net = I3D(**dict_args,
-                  num_classes=NUM_CLASSES)
-    elif args.model_name == "non_local":
-        net = NonLocalI3Res(**dict_args,
-                            num_classes=NUM_CLASSES)
+    net = build_model(**dict_args)
 
     net.to(args.device)
+
     # Loss functions
     criterion = nn.CrossEntropyLoss()
 
+    if args.activation_checkpointing != 'none':
+        report_activation_checkpointing(net, criterion, data_wrapper.train[0][0].shape, args)
+
+    # Reference of the frozen base for --delta_checkpoint, before any training or loading
+    delta_base = utils.DeltaCheckpoint(net) if args.delta_checkpoint else None
+
     # Optimizer vs scheduler
     optimizer = torch.optim.Adam(params=net.parameters(), lr=args.lr)
     scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=args.sl_gammar)
+    scaler = utils.get_grad_scaler(args.precision)
 
     # Wandb logger init
     if args.enable_wandb:
@@ -245,17 +380,41 @@ if __name__ == '__main__':
     else:
         wandb_logger = None
 
+    train_loader = data_wrapper.get_train_dataloader()
+
+    # Resume: weights, optimizer, scheduler, best accuracy and position in the epoch of the last checkpoint
+    start_epoch, best_val_acc, loss_state = 0, 0.0, None
+    if args.resume:
+        checkpoint = utils.load_checkpoint(os.path.join(args.ckp_dir, 'last.pth'), net, optimizer)
+
+        if 'sched_dict' in checkpoint:
+            scheduler.load_state_dict(checkpoint['sched_dict'])
+        if 'scaler_dict' in checkpoint and scaler.is_enabled():
+            scaler.load_state_dict(checkpoint['scaler_dict'])
+        if 'sampler' in checkpoint:
+            train_loader.sampler.load_state_dict(checkpoint['sampler'])
+
+        start_epoch = checkpoint['epoch']
+        best_val_acc = checkpoint.get('best_val_acc', 0.0)
+        loss_state = checkpoint.get('loss_avg')
+        print(f"Resume at epoch {start_epoch + 1}, step {checkpoint.get('step', 0)}")
+
     # Training
     train_and_valid(epochs=args.max_epochs,
                     model=net,
-                    train_loader=data_wrapper.get_train_dataloader(),
+                    train_loader=train_loader,
                     val_loader=data_wrapper.get_val_dataloader(),
                     criterion=criterion,
                     optimizer=optimizer,
                     scheduler=scheduler,
                     wandb_logger=wandb_logger,
                     ckp_dir=args.ckp_dir,
-                    args=args
+                    args=args,
+                    start_epoch=start_epoch,
+                    best_val_acc=best_val_acc,
+                    delta_base=delta_base,
+                    scaler=scaler,
+                    loss_state=loss_state
                     )
 
     # Finish wandb
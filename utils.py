@@ -4,54 +4,344 @@
 #
 #
 
-from albumentations.pytorch import ToTensorV2
 import os
 import json
+import time
+import ctypes
+import hashlib
+import inspect
+import queue
 import random
 import shutil
+import atexit
+import zipfile
+import threading
+import contextlib
 import subprocess
-import pandas as pd
-import albumentations as A
 import cv2
 import numpy as np
 import torch
-import wandb
+
+from model import clip_transforms as CT
+
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)   # ImageNet statistics
+IMAGENET_STD = (0.229, 0.224, 0.225)
 
 
 def get_transforms(args):
 
-    train_transforms = A.ReplayCompose(
+    # With --normalize_on_device the loader ships uint8 clips, see normalize_batch
+    normalize = [] if getattr(args, 'normalize_on_device', False) else [CT.Normalize(IMAGENET_MEAN, IMAGENET_STD)]
+
+    # Frames may be decoded at 1/2, 1/4 or 1/8 of their size before the cubic resize, unless --full_decode
+    reduced_decode = not getattr(args, 'full_decode', False)
+
+    # With --ring_collate, ClipCollator copies the clips into the batch: no contiguous copy before
+    to_tensor = CT.ToTensor(contiguous=not getattr(args, 'ring_collate', False))
+
+    # With --augment, random augmentations (one set of parameters per clip)
+    if getattr(args, 'augment', False):
+        augment = [
+            CT.RandomResizedCrop(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC),
+            CT.HorizontalFlip(p=0.2),
+            CT.VerticalFlip(p=0.2),
+            CT.ColorJitter(p=0.2),
+        ]
+    else:
+        augment = [CT.Resize(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC)]
+
+    train_transforms = CT.ClipCompose(
         [
-            # A.RandomResizedCrop(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC),
-            A.Resize(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC),
-            # A.HorizontalFlip(p=0.2),
-            # A.VerticalFlip(p=0.2),
-            # A.ColorJitter(p=0.2),
-            A.Normalize(),
-            ToTensorV2(),
-        ])
-
-    val_transforms = A.ReplayCompose(
+            *augment,
+            *normalize,
+            to_tensor,
+        ], reduced_decode=reduced_decode)
+
+    val_transforms = CT.ClipCompose(
         [
-            A.Resize(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC),
-            # A.CenterCrop(args.resize_to, args.resize_to),
-            A.Normalize(),
-            ToTensorV2(),
-        ])
+            CT.Resize(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC),
+            # CT.CenterCrop(args.resize_to, args.resize_to),
+            *normalize,
+            to_tensor,
+        ], reduced_decode=reduced_decode)
 
-    test_transforms = A.ReplayCompose(
+    test_transforms = CT.ClipCompose(
         [
-            # A.CenterCrop(args.resize_to, args.resize_to),
-            A.Resize(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC),
-            A.Normalize(),
-            ToTensorV2(),
-        ])
+            # CT.CenterCrop(args.resize_to, args.resize_to),
+            CT.Resize(args.resize_to, args.resize_to, interpolation=cv2.INTER_CUBIC),
+            *normalize,
+            to_tensor,
+        ], reduced_decode=reduced_decode)
 
     return {'train_transforms': train_transforms,
             'val_transforms': val_transforms,
             'test_transforms': test_transforms}
 
 
+def normalize_batch(image):
+    """Normalizes a uint8 batch (..., C, H, W) like A.Normalize() in one vectorised op, on its device.
+    Float batches (already normalized by the loader, or features) are returned unchanged.
+    """
+    if image.dtype != torch.uint8:
+        return image
+
+    mean = torch.tensor(IMAGENET_MEAN, device=image.device).view(3, 1, 1) * 255.0
+    std = torch.tensor(IMAGENET_STD, device=image.device).view(3, 1, 1) * 255.0
+
+    return (image.float() - mean) / std
+
+
+class BatchPrefetcher():
+    """Iterate a data loader `depth` batches ahead on a background thread
+
+    The thread moves every batch to device (on a side CUDA stream) and converts / normalizes it
+    (normalize_batch), so data preparation overlaps with the model compute. depth=0 prepares
+    the batches in the calling thread, as a plain loop would.
+
+    Example:
+    ```
+    batches = BatchPrefetcher(train_loader, device, depth=2)
+    for image, label in batches:
+        ...
+        batches.wait_fraction   # part of the last step spent waiting for data
+    batches.data_wait()         # same over the epoch
+    ```
+    """
+    _END = object()
+
+    def __init__(self, loader, device, depth=2, normalize=True):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.normalize = normalize
+
+        self.wait_fraction = 0.0
+        self.total_wait = 0.0
+        self.total_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def data_wait(self):
+        return self.total_wait / self.total_time if self.total_time else 0.0
+
+    def _stage(self, batch, stream=None):
+
+        image, label = batch
+
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            image = image.to(self.device, non_blocking=True)
+            if self.normalize:
+                image = normalize_batch(image)
+            label = label.to(self.device, non_blocking=True)
+
+        event = None
+        if stream is not None:
+            event = torch.cuda.Event()
+            event.record(stream)
+
+        return image, label, event
+
+    def _put(self, batches, item, stop):
+        # Give up when the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches, stop):
+
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+        try:
+            for batch in self.loader:
+                if not self._put(batches, self._stage(batch, stream), stop):
+                    return
+        except Exception as e:
+            self._put(batches, e, stop)
+            return
+
+        self._put(batches, self._END, stop)
+
+    def _get_batches(self):
+
+        if self.depth <= 0:
+            for batch in self.loader:
+                yield self._stage(batch)
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = batches.get()
+                if item is self._END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+
+        self.total_wait = 0.0
+        self.total_time = 0.0
+
+        batches = self._get_batches()
+        last = time.perf_counter()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = next(batches, None)
+                now = time.perf_counter()
+
+                if item is None:
+                    return
+
+                image, label, event = item
+                if event is not None:
+                    # The batch was copied on the side stream: order it before the compute, and keep
+                    # its memory from being reused by the side stream while the compute uses it
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    image.record_stream(current_stream)
+                    label.record_stream(current_stream)
+
+                wait, step = now - start, now - last
+                self.wait_fraction = wait / step if step > 0 else 0.0
+                self.total_wait += wait
+                self.total_time += step
+                last = now
+
+                yield image, label
+        finally:
+            # Stops the background thread when the loop is left early
+            batches.close()
+
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+
+def get_autocast(precision, device):
+    """
+    Context of the forward passes for --precision: autocast to bf16 (CPU or GPU) or fp16 (GPU),
+    the weights, the gradients and the optimizer stay in fp32
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+
+    if precision == 'fp16' and device.type != 'cuda':
+        raise ValueError("--precision fp16 needs a GPU, use bf16 on CPU")
+
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16 if precision == 'bf16' else torch.float16)
+
+
+def get_grad_scaler(precision):
+    """
+    Loss scaling for fp16, whose small gradients underflow (bf16 has the fp32 range): a no-op otherwise
+    """
+    enabled = precision == 'fp16'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)   # torch < 2.3
+
+
+class ThroughputMeter():
+    """Clips per second and peak memory of a loop
+
+    Peak memory: the CUDA allocator peak since the meter was created on GPU, the peak RSS of the process on CPU
+
+    Example:
+    ```
+    meter = ThroughputMeter(device)
+    for image, label in batches:
+        ...
+        meter.update(len(image))
+    print(f"{meter.clips_per_second():.1f} clips/s, {meter.peak_memory_gb():.2f}GB")
+    ```
+    """
+    def __init__(self, device):
+        self.device = device
+        self.n_clips = 0
+
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+
+        self.start = time.perf_counter()
+
+    def update(self, n_clips):
+        self.n_clips += n_clips
+
+    def clips_per_second(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - self.start
+        return self.n_clips / elapsed if elapsed > 0 else 0.0
+
+    def peak_memory_gb(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) / 2**30
+
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20   # KB on Linux
+
+
+def get_rss():
+    """
+    Resident memory of the process in bytes (Linux), after giving the freed heap memory back to the
+    system so that it only counts what is in use
+    """
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):   # not glibc
+        pass
+
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure_step(model, criterion, image, label, autocast=contextlib.nullcontext()):
+    """
+    Activation memory and time of one forward / backward step
+
+    Activation memory: what is still allocated after the forward, before the backward (CUDA allocator, or the
+    process RSS on CPU), i.e. the tensors autograd keeps for the backward pass
+    """
+    def memory():
+        if image.device.type == 'cuda':
+            torch.cuda.synchronize(image.device)
+            return torch.cuda.memory_allocated(image.device)
+        return get_rss()
+
+    before = memory()
+    start = time.perf_counter()
+
+    with autocast:
+        output = model(image)
+    loss = criterion(output.float(), label)
+
+    activations = memory() - before
+
+    loss.backward()
+    if image.device.type == 'cuda':
+        torch.cuda.synchronize(image.device)
+    elapsed = time.perf_counter() - start
+
+    model.zero_grad(set_to_none=True)
+
+    return activations, elapsed
+
+
 class RunningAverage():
     """A simple class that maintains the running average of a quantity
 
@@ -74,6 +364,13 @@ class RunningAverage():
     def __call__(self):
         return self.total / float(self.steps)
 
+    def state_dict(self):
+        return {'steps': self.steps, 'total': self.total}
+
+    def load_state_dict(self, state):
+        self.steps = state['steps']
+        self.total = state['total']
+
 
 class WandbLogger():
     def __init__(self, args):
@@ -103,6 +400,9 @@ class WandbLogger():
 
         print("Uploading checkpoints to wandb ...")
 
+        # The checkpoints still queued must be on disk first
+        flush_checkpoints()
+
         ckp_dir = self.args.ckp_dir
 
         model_artifact = self._wandb.Artifact(
@@ -141,6 +441,8 @@ class WandbLogger():
         with open(os.path.join(args.ckp_dir, 'wandb_info.json')) as f:
             wandb_info = json.load(f)
 
+        import wandb
+
         # get API
         api = wandb.Api()
         # get run
@@ -182,6 +484,8 @@ def get_map_id_to_label(dataset_name):
     elif dataset_name == "ucf101":
         annotation_path = './data/UCF101/annotation/video_class_to_label.csv'
 
+    import pandas as pd
+
     df = pd.read_csv(annotation_path)
     df = df.sort_values(by="label_id")
 
@@ -223,9 +527,123 @@ def save_dict_to_json(d, json_path):
         json.dump(d, f, indent=4)
 
 
+def snapshot_to_cpu(state):
+    """
+    Copy of a (nested) state dict with every tensor copied to the CPU, safe to write while training goes on
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot_to_cpu(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(value) for value in state)
+    return state
+
+
+class CheckpointWriter():
+    """Write checkpoints on a background thread
+
+    Every file is written to a temporary file then renamed, so a crash never leaves a truncated
+    checkpoint, and best.pth is a hard link to the new last.pth instead of a copy.
+    At most max_pending snapshots wait in the queue: save() blocks beyond that, which caps the memory.
+    """
+    def __init__(self, max_pending=1):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            state, file_path, best_path = self._queue.get()
+            try:
+                if self._error is None:
+                    self._write(state, file_path, best_path)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(state, file_path, best_path):
+
+        tmp_path = file_path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, file_path)
+
+        if best_path:
+            tmp_best_path = best_path + '.tmp'
+            if os.path.exists(tmp_best_path):
+                os.remove(tmp_best_path)
+            try:
+                os.link(file_path, tmp_best_path)
+            except OSError:
+                # No hard links on this file system (e.g. a mounted drive)
+                shutil.copyfile(file_path, tmp_best_path)
+            os.replace(tmp_best_path, best_path)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Checkpoint writing failed") from error
+
+    def save(self, state, file_path, best_path=None):
+        self._raise_error()
+        self._queue.put((snapshot_to_cpu(state), file_path, best_path))
+
+    def flush(self):
+        """
+        Wait until every queued checkpoint is on disk
+        """
+        self._queue.join()
+        self._raise_error()
+
+
+def get_base_hash(model):
+    """
+    Hash of the frozen parameters (requires_grad False) and of the buffers of a model, as constructed
+    """
+    h = hashlib.blake2b(digest_size=16)
+
+    frozen = [(name, param) for name, param in model.named_parameters() if not param.requires_grad]
+    for name, tensor in sorted(frozen + list(model.named_buffers()), key=lambda item: item[0]):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+
+    return h.hexdigest()
+
+
+class DeltaCheckpoint():
+    """Checkpoint only what training changes in a model with a frozen base (LateFusion / LRCN: the ResNet152 trunk)
+
+    state_dict() keeps the parameters with requires_grad and the buffers that differ from the model as
+    constructed; base_hash identifies that frozen base, load_checkpoint rebuilds the full model from a freshly
+    constructed one. Create it right after the model, before training or loading anything.
+    """
+    def __init__(self, model):
+        self.trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+        self.base_buffers = {name: buffer.detach().clone() for name, buffer in model.named_buffers()}
+        self.base_hash = get_base_hash(model)
+
+    def state_dict(self, model):
+        return {name: value for name, value in model.state_dict().items()
+                if name in self.trainable
+                or (name in self.base_buffers and not torch.equal(value, self.base_buffers[name]))}
+
+
+_CHECKPOINT_WRITER = None
+
+
+def flush_checkpoints():
+    if _CHECKPOINT_WRITER is not None:
+        _CHECKPOINT_WRITER.flush()
+
+
 def save_checkpoint(state, is_best, checkpoint):
     """Saves model and training parameters at checkpoint + 'last.pth'. If is_best==True, also saves
-    checkpoint + 'best.pth'
+    checkpoint + 'best.pth'. The state is copied to the CPU right away and written by a background
+    thread (see CheckpointWriter), flush_checkpoints() waits for it.
 
     Args:
         state: (dict) contains model's state_dict, may contain other keys such as epoch, optimizer state_dict
@@ -233,40 +651,107 @@ def save_checkpoint(state, is_best, checkpoint):
         is_best: (bool) True if it is the best model seen till now
         checkpoint: (string) folder where parameters are to be saved
     """
+    global _CHECKPOINT_WRITER
+
     file_path = os.path.join(checkpoint, 'last.pth')
 
     if not os.path.exists(checkpoint):
         print("Checkpoint Directory does not exist! Making directory {}".format(checkpoint))
         os.makedirs(checkpoint)
 
+    if _CHECKPOINT_WRITER is None:
+        _CHECKPOINT_WRITER = CheckpointWriter()
+        atexit.register(flush_checkpoints)
+
     print(f"Saving checkpoint...")
-    torch.save(state, file_path)
+    _CHECKPOINT_WRITER.save(state, file_path, os.path.join(checkpoint, 'best.pth') if is_best else None)
+
+
+# torch >= 2.1: torch.load(mmap=True)
+_CAN_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+
+def _load_state(file_path, map_location):
+    """
+    torch.load with the tensors memory-mapped from the file (torch >= 2.1, zip format):
+    only what is used is read, straight onto map_location
+    """
+    # Legacy (non zip) torch.save files can not be memory-mapped
+    if _CAN_MMAP and zipfile.is_zipfile(file_path):
+        return torch.load(file_path, map_location=map_location, mmap=True)
+    return torch.load(file_path, map_location=map_location)
+
+
+def _same_device(device, other):
+    """
+    device == other, with cuda the current cuda device (torch.device('cuda') != torch.device('cuda:0'))
+    """
+    device, other = torch.device(device), torch.device(other)
+
+    def _index(device):
+        if device.index is None and device.type == 'cuda':
+            return torch.cuda.current_device()
+        return device.index
+
+    return device.type == other.type and _index(device) == _index(other)
 
-    if is_best:
-        shutil.copyfile(file_path, os.path.join(checkpoint, 'best.pth'))
 
+def _load_state_dict(model, state_dict, strict, assign):
+    if assign:
+        try:
+            return model.load_state_dict(state_dict, strict=strict, assign=True)
+        except TypeError:   # torch < 2.1
+            pass
+    return model.load_state_dict(state_dict, strict=strict)
 
-def load_checkpoint(checkpoint, model, optimizer=None):
+
+def load_checkpoint(checkpoint, model, optimizer=None, map_location=None):
     """Loads model parameters (state_dict) from file_path. If optimizer is provided, loads state_dict of
     optimizer assuming it is present in checkpoint.
 
+    The tensors are memory-mapped and loaded directly on map_location. Without optimizer, its state is
+    never read and the loaded tensors are assigned to the model instead of copied into it.
+
     Args:
         checkpoint: (string) filename which needs to be loaded
         model: (torch.nn.Module) model for which the parameters are loaded
         optimizer: (torch.optim) optional: resume optimizer from checkpoint
+        map_location: (torch.device) optional: device of the loaded tensors, default: the device of the model
     """
 
+    # A checkpoint of this process may still be in the writer queue
+    flush_checkpoints()
+
     if not os.path.exists(checkpoint):
-        raise("File doesn't exist {}".format(checkpoint))
+        raise FileNotFoundError("File doesn't exist {}".format(checkpoint))
 
     print(f"Load checkpoint from {checkpoint}")
 
-    checkpoint = torch.load(checkpoint)
+    if map_location is None:
+        map_location = next(model.parameters()).device
+
+    checkpoint = _load_state(checkpoint, map_location)
+
+    # The optimizer keeps references to the parameters: they must be updated in place
+    assign = optimizer is None and _same_device(map_location, next(model.parameters()).device)
+
+    if 'base_hash' in checkpoint:
+        # Delta checkpoint (DeltaCheckpoint): the frozen base comes from the model as constructed
+        if get_base_hash(model) != checkpoint['base_hash']:
+            raise ValueError("The frozen base of the model differs from the one of the delta checkpoint")
+
+        unexpected = set(checkpoint['state_dict']) - set(model.state_dict())
+        if unexpected:
+            raise KeyError(f"Unexpected keys in the delta checkpoint: {sorted(unexpected)}")
 
-    model.load_state_dict(checkpoint['state_dict'])  # maybe epoch as well
+        _load_state_dict(model, checkpoint['state_dict'], strict=False, assign=assign)
+    else:
+        _load_state_dict(model, checkpoint['state_dict'], strict=True, assign=assign)  # maybe epoch as well
 
     if optimizer:
         optimizer.load_state_dict(checkpoint['optim_dict'])
+    else:
+        checkpoint.pop('optim_dict', None)
 
     return checkpoint
 